@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import sys
+from multiprocessing.pool import ThreadPool
 
 from midonetclient.api import MidonetApi
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 PROVIDER_ROUTER_NAME = 'MidonetProviderRouter'
+HOST_UUID_PATH = '/etc/midolman/host_uuid.properties'
 provider_tenant_id = None
 
 
@@ -27,6 +35,13 @@ def _get_or_create_provider_router(provider_tenant_id):
                    .name(PROVIDER_ROUTER_NAME)\
                    .create()
 
+def _get_local_host_uuid():
+    f = open(HOST_UUID_PATH)
+    lines = f.readlines()
+    f.close()
+    return filter(lambda x: x.startswith('host_uuid='),
+                  lines)[0].strip()[len('host_uuid='):]
+
 def setup_provider_devices(args):
     # Handle provider router
     provider_router = _get_or_create_provider_router(provider_tenant_id)
@@ -35,36 +50,533 @@ def setup_provider_devices(args):
     print "provider_router_id=%s" %  provider_router.get_id()
 
 def setup_fake_uplink(args):
-    routers = mido_api.get_routers(
-                    {'tenant_id': provider_tenant_id})
+    """
+    Adds the uplink port, its binding to the midonet interface of this host
+    and the default route to the provider router, unless already there.
+    """
+    spec = {'routers': [{
+        'name': PROVIDER_ROUTER_NAME,
+        'ports': [{'address': '100.100.100.1',
+                   'network': '100.100.100.0/24',
+                   'host': 'local',
+                   'interface': 'midonet'}],
+        'routes': [{'dst': '0.0.0.0/0',
+                    'next_hop_gateway': '100.100.100.2',
+                    'next_hop_port': '100.100.100.1',
+                    'weight': 100}]}]}
+    Topology(mido_api, provider_tenant_id).apply(spec)
+
+
+def _split_cidr(cidr):
+    address, length = cidr.split('/')
+    return address, int(length)
+
+
+class Topology(object):
+    """
+    Applies a topology spec idempotently: resources are matched against the
+    current state, fetched once, and only the missing ones are created,
+    those independent of each other in parallel.
+
+    The spec is a dictionary, usually loaded from JSON or YAML:
+
+        tenant_id: optional, defaults to the provider tenant
+        bridges:
+          - name: b1
+        routers:
+          - name: r1
+            ports:
+              - address: 10.0.0.1      # identifies the port
+                network: 10.0.0.0/24
+                bridge: b1             # optional, link to a port of b1
+                host: local            # optional, host uuid or local
+                interface: eth1        # bound on host
+            routes:
+              - dst: 0.0.0.0/0
+                src: 0.0.0.0/0         # optional
+                next_hop_gateway: 10.0.0.2
+                next_hop_port: 10.0.0.1
+                weight: 100            # optional
+    """
+
+    def __init__(self, api, tenant_id, workers=8, verbose=True):
+        self.api = api
+        self.tenant_id = tenant_id
+        self.workers = workers
+        self.verbose = verbose
+        self._pool = None
+
+    def _log(self, msg):
+        if self.verbose:
+            print msg
+
+    def _map(self, func, items):
+        items = list(items)
+        if len(items) <= 1 or self.workers <= 1:
+            return [func(i) for i in items]
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool.map(func, items)
+
+    # current state
+
+    def _fetch(self, tenant_id, host_ids):
+        """Fetches the routers and bridges of the tenant with their ports and
+           routes, and the interface bindings of the hosts.
+        """
+        routers = dict((r.get_name(), r) for r in
+                       self.api.get_routers({'tenant_id': tenant_id}))
+        bridges = dict((b.get_name(), b) for b in
+                       self.api.get_bridges({'tenant_id': tenant_id}))
+
+        def router_state(r):
+            return r.get_ports(), r.get_routes()
+        states = self._map(router_state, routers.values())
+        self.router_ports = {}
+        self.router_routes = {}
+        for r, (ports, routes) in zip(routers.values(), states):
+            self.router_ports[r.get_id()] = ports
+            self.router_routes[r.get_id()] = routes
+
+        self.bridge_ports = dict(zip(
+            [b.get_id() for b in bridges.values()],
+            self._map(lambda b: b.get_ports(), bridges.values())))
+
+        self.hosts = dict(zip(host_ids,
+                              self._map(self.api.get_host, host_ids)))
+        self.host_ports = dict(zip(
+            host_ids, self._map(lambda h: self.hosts[h].get_ports(),
+                                host_ids)))
+        return routers, bridges
+
+    # applying
+
+    def apply(self, spec):
+        tenant_id = spec.get('tenant_id') or self.tenant_id
+        router_specs = spec.get('routers', [])
+        bridge_specs = spec.get('bridges', [])
+
+        host_ids = set()
+        for rs in router_specs:
+            for ps in rs.get('ports', []):
+                if ps.get('host'):
+                    host_ids.add(self._host_id(ps['host']))
+        routers, bridges = self._fetch(tenant_id, sorted(host_ids))
+
+        # routers and bridges
+        def create_router(name):
+            self._log('creating router %s' % name)
+            return self.api.add_router().tenant_id(tenant_id).name(name)\
+                                        .create()
+
+        def create_bridge(name):
+            self._log('creating bridge %s' % name)
+            return self.api.add_bridge().tenant_id(tenant_id).name(name)\
+                                        .create()
+
+        new_routers = [rs['name'] for rs in router_specs
+                       if rs['name'] not in routers]
+        new_bridges = [bs['name'] for bs in bridge_specs
+                       if bs['name'] not in bridges]
+        for name, r in zip(new_routers, self._map(create_router,
+                                                  new_routers)):
+            routers[name] = r
+            self.router_ports[r.get_id()] = []
+            self.router_routes[r.get_id()] = []
+        for name, b in zip(new_bridges, self._map(create_bridge,
+                                                  new_bridges)):
+            bridges[name] = b
+            self.bridge_ports[b.get_id()] = []
+
+        # router ports
+        port_specs = []
+        ports = {}
+        for rs in router_specs:
+            router = routers[rs['name']]
+            for ps in rs.get('ports', []):
+                port = self._find_router_port(router, ps['address'])
+                if port:
+                    ports[(rs['name'], ps['address'])] = port
+                else:
+                    port_specs.append((rs['name'], ps))
+
+        def create_router_port(item):
+            router_name, ps = item
+            self._log('creating port %s on router %s' % (ps['address'],
+                                                         router_name))
+            network, length = _split_cidr(ps['network'])
+            return routers[router_name].add_port()\
+                                       .port_address(ps['address'])\
+                                       .network_address(network)\
+                                       .network_length(length).create()
+
+        for (router_name, ps), port in zip(
+                port_specs, self._map(create_router_port, port_specs)):
+            ports[(router_name, ps['address'])] = port
+
+        # links, host bindings and routes only depend on the ports
+        tasks = []
+        for rs in router_specs:
+            router = routers[rs['name']]
+            for ps in rs.get('ports', []):
+                port = ports[(rs['name'], ps['address'])]
+                if ps.get('bridge'):
+                    bridge = bridges[ps['bridge']]
+                    if not self._is_linked(port, bridge):
+                        tasks.append((self._link, (port, bridge)))
+                if ps.get('host'):
+                    host_id = self._host_id(ps['host'])
+                    if not self._is_bound(host_id, port, ps['interface']):
+                        tasks.append((self._bind,
+                                      (host_id, port, ps['interface'])))
+            for route in rs.get('routes', []):
+                if not self._find_route(router, route):
+                    next_hop = ports[(rs['name'], route['next_hop_port'])]
+                    tasks.append((self._add_route, (router, route, next_hop)))
+        self._map(lambda task: task[0](*task[1]), tasks)
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        return routers, bridges
+
+    def _host_id(self, host):
+        if host == 'local':
+            return _get_local_host_uuid()
+        return host
+
+    def _find_router_port(self, router, address):
+        for p in self.router_ports[router.get_id()]:
+            if p.get_port_address() == address:
+                return p
+        return None
+
+    def _is_linked(self, port, bridge):
+        peer_id = port.get_peer_id()
+        return bool(peer_id) and peer_id in [
+            p.get_id() for p in self.bridge_ports[bridge.get_id()]]
+
+    def _link(self, port, bridge):
+        self._log('linking port %s to bridge %s' % (port.get_port_address(),
+                                                    bridge.get_name()))
+        bridge_port = bridge.add_port().create()
+        port.link(bridge_port.get_id())
+
+    def _is_bound(self, host_id, port, interface):
+        for hp in self.host_ports[host_id]:
+            if hp.get_port_id() == port.get_id() and \
+                    hp.get_interface_name() == interface:
+                return True
+        return False
+
+    def _bind(self, host_id, port, interface):
+        self._log('binding port %s to %s on host %s' % (
+            port.get_port_address(), interface, host_id))
+        self.hosts[host_id].add_host_interface_port()\
+                           .port_id(port.get_id())\
+                           .interface_name(interface).create()
+
+    def _find_route(self, router, route):
+        dst, dst_length = _split_cidr(route['dst'])
+        src, src_length = _split_cidr(route.get('src', '0.0.0.0/0'))
+        for r in self.router_routes[router.get_id()]:
+            if (r.get_dst_network_addr() == dst and
+                    r.get_dst_network_length() == dst_length and
+                    r.get_src_network_addr() == src and
+                    r.get_src_network_length() == src_length and
+                    r.get_next_hop_gateway() == route['next_hop_gateway']):
+                return r
+        return None
+
+    def _add_route(self, router, route, next_hop_port):
+        self._log('adding route to %s via %s on router %s' % (
+            route['dst'], route['next_hop_gateway'], router.get_name()))
+        dst, dst_length = _split_cidr(route['dst'])
+        src, src_length = _split_cidr(route.get('src', '0.0.0.0/0'))
+        router.add_route().type('Normal')\
+                          .src_network_addr(src)\
+                          .src_network_length(src_length)\
+                          .dst_network_addr(dst)\
+                          .dst_network_length(dst_length)\
+                          .weight(route.get('weight', 100))\
+                          .next_hop_gateway(route['next_hop_gateway'])\
+                          .next_hop_port(next_hop_port.get_id()).create()
 
-    for r in routers:
-        if r.get_name() == 'MidonetProviderRouter':
-            provider_router = r
-            uplink_port =  provider_router.add_port()\
-                                          .port_address('100.100.100.1')\
-                                          .network_address('100.100.100.0')\
-                                          .network_length(24).create()
-
-    # get host id to create a vport if mapping
-    f = open('/etc/midolman/host_uuid.properties')
-    lines = f.readlines()
-    host_uuid = filter(lambda x: x.startswith('host_uuid='),
-                       lines)[0].strip()[len('host_uuid='):]
 
-    mido_api.get_host(host_uuid).add_host_interface_port()\
-                           .port_id(uplink_port.get_id())\
-                           .interface_name('midonet').create()
+# resources dumped by export, with the fields restored by restore
+SG_CHAIN_PREFIX = 'os_sg_'
+# VIF chains are not exported: bridge ports are not either, and nova-compute
+# only sets up the filters of a VIF whose chains do not exist
+VIF_CHAIN_PREFIX = 'os_sg_vif_'
+ROUTER_CHAIN_PREFIXES = ('OS_IN_', 'OS_OUT_')
+CHAIN_FIELDS = ('name',)
+PORT_GROUP_FIELDS = ('name',)
+RULE_FIELDS = ('type', 'position', 'cond_invert', 'match_forward_flow',
+               'match_return_flow', 'port_group', 'inv_port_group',
+               'dl_type', 'inv_dl_type', 'dl_src', 'inv_dl_src', 'dl_dst',
+               'inv_dl_dst', 'nw_tos', 'inv_nw_tos', 'nw_proto',
+               'inv_nw_proto', 'nw_src_address', 'nw_src_length',
+               'inv_nw_src', 'nw_dst_address', 'nw_dst_length', 'inv_nw_dst',
+               'tp_src', 'inv_tp_src', 'tp_dst', 'inv_tp_dst',
+               'jump_chain_id', 'jump_chain_name', 'flow_action',
+               'nat_targets', 'properties')
+ROUTER_FIELDS = ('name',)
+ROUTER_FILTER_FIELDS = ('inbound_filter_id', 'outbound_filter_id')
+PORT_FIELDS = ('port_address', 'network_address', 'network_length',
+               'inbound_filter_id', 'outbound_filter_id')
+ROUTE_FIELDS = ('type', 'src_network_addr', 'src_network_length',
+                'dst_network_addr', 'dst_network_length', 'next_hop_gateway',
+                'next_hop_port', 'weight')
 
-    # Add default route to the uplink
-    provider_router.add_route().type('Normal')\
-                   .src_network_addr('0.0.0.0')\
-                   .src_network_length(0)\
-                   .dst_network_addr('0.0.0.0')\
-                   .dst_network_length(0)\
-                   .weight(100)\
-                   .next_hop_gateway('100.100.100.2')\
-                   .next_hop_port(uplink_port.get_id()).create()
+# fields holding the id of another exported resource
+ID_FIELDS = ('jump_chain_id', 'port_group', 'inbound_filter_id',
+             'outbound_filter_id', 'next_hop_port', 'port_id')
+
+
+def _record(kind, resource, fields, **extra):
+    record = {'kind': kind, 'id': resource.get_id()}
+    for f in fields:
+        value = getattr(resource, 'get_' + f)()
+        if value is not None and value is not False:
+            record[f] = value
+    record.update(extra)
+    return record
+
+
+class Exporter(object):
+    """
+    Writes the chains, port groups and rules created for security groups
+    and routers, and the provider router with its ports, routes and host
+    bindings, as one JSON record per line. Records come in an order where
+    every id a record refers to has been defined by an earlier record, and
+    only one tenant's chain listing is held at a time.
+    """
+
+    def __init__(self, api, out, workers=8):
+        self.api = api
+        self.out = out
+        self.workers = workers
+        self.count = 0
+
+    def _write(self, record):
+        self.out.write(json.dumps(record, separators=(',', ':'),
+                                  sort_keys=True))
+        self.out.write('\n')
+        self.count += 1
+
+    def _map(self, func, items):
+        items = list(items)
+        if len(items) <= 1 or self.workers <= 1:
+            return [func(i) for i in items]
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+
+    def export_tenant(self, tenant_id):
+        routers = [r for r in self.api.get_routers({'tenant_id': tenant_id})
+                   if r.get_name() == PROVIDER_ROUTER_NAME]
+        for r in routers:
+            self._write(_record('router', r, ROUTER_FIELDS,
+                                tenant_id=tenant_id))
+
+        chains = [c for c in self.api.get_chains({'tenant_id': tenant_id})
+                  if (c.get_name().startswith(SG_CHAIN_PREFIX) and
+                      not c.get_name().startswith(VIF_CHAIN_PREFIX)) or
+                  c.get_name().startswith(ROUTER_CHAIN_PREFIXES)]
+        for c in chains:
+            self._write(_record('chain', c, CHAIN_FIELDS,
+                                tenant_id=tenant_id))
+
+        for pg in self.api.get_port_groups({'tenant_id': tenant_id}):
+            if pg.get_name().startswith(SG_CHAIN_PREFIX):
+                self._write(_record('port_group', pg, PORT_GROUP_FIELDS,
+                                    tenant_id=tenant_id))
+
+        # rules are fetched a few chains at a time and written per chain
+        for i in range(0, len(chains), self.workers):
+            batch = chains[i:i + self.workers]
+            for c, rules in zip(batch, self._map(lambda c: c.get_rules(),
+                                                 batch)):
+                for r in rules:
+                    self._write(_record('rule', r, RULE_FIELDS,
+                                        chain_id=c.get_id()))
+
+        port_ids = set()
+        for r in routers:
+            self._write(_record('router_filters', r, ROUTER_FILTER_FIELDS))
+            for p in r.get_ports():
+                port_ids.add(p.get_id())
+                self._write(_record('router_port', p, PORT_FIELDS,
+                                    router_id=r.get_id()))
+            for route in r.get_routes():
+                self._write(_record('route', route, ROUTE_FIELDS,
+                                    router_id=r.get_id()))
+
+        if port_ids:
+            for host in self.api.get_hosts():
+                for hp in host.get_ports():
+                    if hp.get_port_id() in port_ids:
+                        self._write({'kind': 'binding',
+                                     'host_id': host.get_id(),
+                                     'port_id': hp.get_port_id(),
+                                     'interface_name':
+                                         hp.get_interface_name()})
+
+
+class Restorer(object):
+    """
+    Replays a file written by Exporter into an empty MidoNet. Records are
+    read one at a time and created in batches of consecutive records of the
+    same kind, concurrently; the rules of a chain are created one after
+    another to keep their positions. New ids replace the exported ones in
+    the records that refer to them, and router chain names follow the new
+    router ids.
+    """
+
+    def __init__(self, api, workers=8, batch_size=200):
+        self.api = api
+        self.workers = workers
+        self.batch_size = batch_size
+        self.ids = {}
+        self.count = 0
+        self._pool = ThreadPool(workers) if workers > 1 else None
+
+    def _map(self, func, items):
+        if self._pool is None or len(items) <= 1:
+            return [func(i) for i in items]
+        return self._pool.map(func, items)
+
+    def _remap(self, record):
+        for f in ID_FIELDS:
+            if record.get(f) in self.ids:
+                record[f] = self.ids[record[f]]
+        return record
+
+    def _build(self, builder, record, fields):
+        for f in fields:
+            if f in record:
+                builder = getattr(builder, f)(record[f])
+        return builder
+
+    def restore(self, lines):
+        batch = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if batch and (batch[0]['kind'] != record['kind'] or
+                          len(batch) >= self.batch_size):
+                self._flush(batch)
+                batch = []
+            batch.append(record)
+        if batch:
+            self._flush(batch)
+        if self._pool is not None:
+            self._pool.close()
+
+    def _flush(self, batch):
+        kind = batch[0]['kind']
+        if kind == 'rule':
+            # one task per chain, rules of a chain in file order
+            by_chain = {}
+            order = []
+            for record in batch:
+                if record['chain_id'] not in by_chain:
+                    order.append(record['chain_id'])
+                by_chain.setdefault(record['chain_id'], []).append(record)
+            self._map(self._restore_rules, [by_chain[c] for c in order])
+        else:
+            results = self._map(getattr(self, '_restore_' + kind), batch)
+            for record, new_id in zip(batch, results):
+                if new_id is not None:
+                    self.ids[record['id']] = new_id
+        self.count += len(batch)
+
+    def _restore_router(self, record):
+        return self._build(self.api.add_router(), record, ROUTER_FIELDS)\
+                   .tenant_id(record['tenant_id']).create().get_id()
+
+    def _restore_chain(self, record):
+        name = record['name']
+        for prefix in ROUTER_CHAIN_PREFIXES:
+            router_id = name[len(prefix):]
+            if name.startswith(prefix) and router_id in self.ids:
+                name = prefix + self.ids[router_id]
+        return self.api.add_chain().tenant_id(record['tenant_id'])\
+                                   .name(name).create().get_id()
+
+    def _restore_port_group(self, record):
+        return self._build(self.api.add_port_group(), record,
+                           PORT_GROUP_FIELDS)\
+                   .tenant_id(record['tenant_id']).create().get_id()
+
+    def _restore_rules(self, records):
+        chain = self.api.get_chain(self.ids[records[0]['chain_id']])
+        for record in records:
+            self._build(chain.add_rule(), self._remap(record),
+                        RULE_FIELDS).create()
+
+    def _restore_router_filters(self, record):
+        router = self.api.get_router(self.ids[record['id']])
+        self._build(router, self._remap(record), ROUTER_FILTER_FIELDS)\
+            .update()
+
+    def _restore_router_port(self, record):
+        router = self.api.get_router(self.ids[record['router_id']])
+        return self._build(router.add_port(), self._remap(record),
+                           PORT_FIELDS).create().get_id()
+
+    def _restore_route(self, record):
+        router = self.api.get_router(self.ids[record['router_id']])
+        self._build(router.add_route(), self._remap(record),
+                    ROUTE_FIELDS).create()
+
+    def _restore_binding(self, record):
+        self._remap(record)
+        self.api.get_host(record['host_id']).add_host_interface_port()\
+                .port_id(record['port_id'])\
+                .interface_name(record['interface_name']).create()
+
+
+def export_topology(args):
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    exporter = Exporter(mido_api, out, args.workers)
+    try:
+        for tenant_id in args.tenant or [provider_tenant_id]:
+            exporter.export_tenant(tenant_id)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write('exported %d records\n' % exporter.count)
+
+def restore_topology(args):
+    restorer = Restorer(mido_api, args.workers, args.batch_size)
+    f = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        restorer.restore(f)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    sys.stderr.write('restored %d records\n' % restorer.count)
+
+
+def _load_spec(path):
+    f = open(path)
+    try:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                sys.exit('PyYAML is needed to read %s' % path)
+            return yaml.safe_load(f)
+        return json.load(f)
+    finally:
+        f.close()
+
+def apply_topology(args):
+    Topology(mido_api, provider_tenant_id, args.workers).apply(
+        _load_spec(args.spec))
 
 
 def main():
@@ -93,6 +605,32 @@ def main():
                                               help='set up fake uplink')
     parser_fake_uplink.set_defaults(func=setup_fake_uplink)
 
+    parser_apply = subparsers.add_parser(
+        'apply', help='create what is missing from a topology spec')
+    parser_apply.add_argument('spec', help='JSON or YAML topology spec')
+    parser_apply.add_argument('--workers', type=int, default=8,
+                              help='resources created in parallel')
+    parser_apply.set_defaults(func=apply_topology)
+
+    parser_export = subparsers.add_parser(
+        'export', help='dump security group and provider router resources')
+    parser_export.add_argument('output', help='file to write, - for stdout')
+    parser_export.add_argument('--tenant', action='append',
+                               help=('tenant to export, repeatable; the '
+                                     'provider tenant by default'))
+    parser_export.add_argument('--workers', type=int, default=8,
+                               help='concurrent requests')
+    parser_export.set_defaults(func=export_topology)
+
+    parser_restore = subparsers.add_parser(
+        'restore', help='recreate the resources of an export')
+    parser_restore.add_argument('input', help='file to read, - for stdin')
+    parser_restore.add_argument('--workers', type=int, default=8,
+                                help='concurrent requests')
+    parser_restore.add_argument('--batch-size', type=int, default=200,
+                                help='records created together')
+    parser_restore.set_defaults(func=restore_topology)
+
 
     args = base_parser.parse_args()
 
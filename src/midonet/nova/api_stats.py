@@ -0,0 +1,275 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Counts and times the MidoNet API requests made by this process.
+
+Requests are tagged with the driver entry point that made them, e.g.
+prepare_instance_filter or plug, and summarized periodically in the log
+and/or in a JSON file.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('nova...' + __name__)
+
+api_stats_opts = [
+    cfg.BoolOpt('api_stats',
+                default=False,
+                help=('Count and time MidoNet API requests per operation '
+                      'and caller.')),
+    cfg.IntOpt('api_stats_interval',
+               default=300,
+               help=('Seconds between two summaries of the MidoNet API '
+                     'request statistics. 0 disables the summaries.')),
+    cfg.StrOpt('api_stats_file',
+               default=None,
+               help=('File the MidoNet API request statistics are written '
+                     'to as JSON at every summary. Each process, e.g. each '
+                     'nova-api worker, writes its own file, this path '
+                     'followed by .<pid>.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(api_stats_opts, 'MIDONET')
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, None)
+
+REST_METHODS = ('create', 'update', 'delete')
+
+_local = threading.local()
+
+
+def current_caller():
+    return getattr(_local, 'caller', None) or 'unknown'
+
+
+def tagged(func):
+    """Decorator tagging the MidoNet API requests made while the function
+       runs with its name. Nested tags keep the outermost one.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'caller', None):
+            return func(*args, **kwargs)
+        _local.caller = func.__name__
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.caller = None
+    return wrapper
+
+
+def propagate_caller(task):
+    """Returns task wrapped so that the requests it makes from another
+       thread or greenthread are tagged like those of the calling one.
+    """
+    caller = getattr(_local, 'caller', None)
+    if not caller:
+        return task
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'caller', None)
+        _local.caller = caller
+        try:
+            return task(*args, **kwargs)
+        finally:
+            _local.caller = previous
+    return wrapper
+
+
+class OperationStats:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, elapsed_ms, nbytes, error):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.bytes += nbytes
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if bound is None or elapsed_ms <= bound:
+                self.histogram[i] += 1
+                break
+
+    def to_dict(self):
+        buckets = {}
+        for bound, n in zip(LATENCY_BUCKETS, self.histogram):
+            buckets['le_%s' % (bound or 'inf')] = n
+        return {'count': self.count,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'total_ms': round(self.total_ms, 3),
+                'max_ms': round(self.max_ms, 3),
+                'histogram_ms': buckets}
+
+
+class ApiStats:
+    """Statistics of MidoNet API requests keyed by (caller, operation)."""
+
+    def __init__(self, interval=None, path=None):
+        if interval is None:
+            interval = CONF.MIDONET.api_stats_interval
+        if path is None:
+            path = CONF.MIDONET.api_stats_file
+        self.interval = interval
+        self.path = path
+        self._ops = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._next_report = self._started + interval
+
+    def record(self, operation, elapsed, nbytes=0, error=False):
+        key = (current_caller(), operation)
+        with self._lock:
+            stats = self._ops.get(key)
+            if stats is None:
+                stats = self._ops[key] = OperationStats()
+            stats.add(elapsed * 1000.0, nbytes, error)
+            report = self.interval > 0 and time.time() >= self._next_report
+            if report:
+                self._next_report = time.time() + self.interval
+        if report:
+            self.report()
+
+    def snapshot(self):
+        """Returns the statistics as a dictionary serializable to JSON."""
+        with self._lock:
+            ops = [dict(caller=c, operation=o, **s.to_dict())
+                   for (c, o), s in sorted(self._ops.items())]
+        return {'pid': os.getpid(),
+                'since': self._started,
+                'time': time.time(),
+                'operations': ops}
+
+    def report(self):
+        """Logs a summary and writes the statistics file if configured."""
+        data = self.snapshot()
+        for op in data['operations']:
+            LOG.info('MidoNet API caller=%s operation=%s count=%d errors=%d '
+                     'bytes=%d avg_ms=%.1f max_ms=%.1f',
+                     op['caller'], op['operation'], op['count'],
+                     op['errors'], op['bytes'],
+                     op['total_ms'] / op['count'], op['max_ms'])
+        if self.path:
+            # the workers of a service would overwrite each other's file
+            path = '%s.%d' % (self.path, data['pid'])
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                LOG.exception('Failed to write MidoNet API stats to %s',
+                              path)
+
+
+def _payload_size(obj):
+    """Approximates the size of the JSON exchanged for a resource or list of
+       resources from their DTOs.
+    """
+    if isinstance(obj, list):
+        return sum(_payload_size(o) for o in obj)
+    dto = getattr(obj, 'dto', None)
+    if dto is None:
+        return 0
+    try:
+        return len(json.dumps(dto))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _is_resource(obj):
+    return hasattr(obj, 'dto')
+
+
+def _wrap(obj, stats):
+    if isinstance(obj, InstrumentedProxy):
+        return obj
+    if _is_resource(obj):
+        return InstrumentedProxy(obj, stats, type(obj).__name__.lower())
+    if isinstance(obj, list) and obj and _is_resource(obj[0]):
+        return [_wrap(o, stats) for o in obj]
+    return obj
+
+
+class InstrumentedProxy(object):
+    """Wraps the MidoNet API or a resource returned by it and records the
+       methods that result in REST requests: create, update, delete and the
+       get_* methods returning resources. Resources returned are wrapped
+       too, so chained builder calls are recorded as well.
+    """
+
+    def __init__(self, target, stats, kind='api'):
+        self._target = target
+        self._stats = stats
+        self._kind = kind
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                if name in REST_METHODS or name.startswith('get_'):
+                    self._stats.record('%s.%s' % (self._kind, name),
+                                       time.time() - start, error=True)
+                raise
+            elapsed = time.time() - start
+
+            if name in REST_METHODS:
+                self._stats.record('%s.%s' % (self._kind, name), elapsed,
+                                   _payload_size(self._target))
+            elif name.startswith('get_') and (_is_resource(result) or
+                                              isinstance(result, list)):
+                self._stats.record('%s.%s' % (self._kind, name), elapsed,
+                                   _payload_size(result))
+            if result is self._target:
+                # fluent builder call
+                return self
+            return _wrap(result, self._stats)
+        return call
+
+    def __repr__(self):
+        return repr(self._target)
+
+
+def instrument(mido_api, stats=None):
+    """Returns mido_api wrapped so that its requests are recorded."""
+    if stats is None:
+        stats = ApiStats()
+    return InstrumentedProxy(mido_api, stats)
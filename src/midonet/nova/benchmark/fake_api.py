@@ -0,0 +1,311 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""In-process fake of the midonetclient MidonetApi.
+
+It keeps chains, rules, port groups, bridges, routers, ports and hosts in
+memory, counts every call that would be a REST request and can sleep for a
+configurable time on each of them to mimic a remote API server.
+"""
+
+import collections
+import threading
+import time
+import uuid
+
+from webob import exc as w_exc
+
+
+class FakeResource(object):
+    """A resource that is also its own builder.
+
+    Any unknown method name(value) sets a field and returns the resource,
+    and get_<field>() returns it, like the midonetclient resources do.
+    """
+
+    kind = 'resource'
+
+    def __init__(self, api, **fields):
+        self._api = api
+        self.dto = dict(fields)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name.startswith('get_'):
+            field = name[len('get_'):]
+            return lambda: self.dto.get(field)
+
+        def setter(value):
+            self.dto[name] = value
+            return self
+        return setter
+
+    def create(self):
+        self._api._request('POST', self.kind)
+        self.dto['id'] = str(uuid.uuid4())
+        self._on_create()
+        self._api._store(self)
+        return self
+
+    def update(self):
+        self._api._request('PUT', self.kind)
+        self._api._lookup(self.kind, self.dto['id'])
+        return self
+
+    def delete(self):
+        self._api._request('DELETE', self.kind)
+        self._api._lookup(self.kind, self.dto['id'])
+        self._on_delete()
+        self._api._discard(self)
+
+    def _on_create(self):
+        pass
+
+    def _on_delete(self):
+        pass
+
+    def _children(self, kind, key):
+        self._api._request('GET', kind + 's')
+        return [r for r in self._api._all(kind)
+                if r.dto.get(key) == self.dto['id']]
+
+    def __repr__(self):
+        return '<Fake%s %s>' % (self.kind, self.dto.get('name') or
+                                self.dto.get('id'))
+
+
+class FakeRule(FakeResource):
+
+    kind = 'rule'
+
+    def _on_create(self):
+        chain = self._api._lookup('chain', self.dto['chain_id'])
+        position = self.dto.get('position') or len(chain._rules) + 1
+        if position < 1 or position > len(chain._rules) + 1:
+            raise w_exc.HTTPBadRequest('Position exceeds number of rules')
+        self.dto['position'] = position
+        chain._rules.insert(position - 1, self)
+
+    def _on_delete(self):
+        chain = self._api._lookup('chain', self.dto['chain_id'])
+        chain._rules.remove(self)
+
+
+class FakeChain(FakeResource):
+
+    kind = 'chain'
+
+    def __init__(self, api, **fields):
+        super(FakeChain, self).__init__(api, **fields)
+        self._rules = []
+
+    def add_rule(self):
+        return FakeRule(self._api, chain_id=self.dto.get('id'))
+
+    def get_rules(self):
+        self._api._request('GET', 'rules')
+        for i, r in enumerate(self._rules, 1):
+            r.dto['position'] = i
+        return list(self._rules)
+
+    def _on_delete(self):
+        for r in list(self._rules):
+            self._api._discard(r)
+
+
+class FakePortGroupPort(FakeResource):
+
+    kind = 'port_group_port'
+
+
+class FakePortGroup(FakeResource):
+
+    kind = 'port_group'
+
+    def add_port_group_port(self):
+        return FakePortGroupPort(self._api, port_group_id=self.dto.get('id'))
+
+    def get_ports(self):
+        return self._children('port_group_port', 'port_group_id')
+
+
+class FakePort(FakeResource):
+
+    kind = 'port'
+
+    def link(self, peer_id):
+        self._api._request('POST', 'link')
+        peer = self._api._lookup('port', peer_id)
+        self.dto['peer_id'] = peer_id
+        peer.dto['peer_id'] = self.dto['id']
+        return self
+
+
+class FakeRoute(FakeResource):
+
+    kind = 'route'
+
+
+class FakeDevice(FakeResource):
+
+    def add_port(self):
+        return FakePort(self._api, device_id=self.dto.get('id'))
+
+    def get_ports(self):
+        return self._children('port', 'device_id')
+
+
+class FakeBridge(FakeDevice):
+
+    kind = 'bridge'
+
+
+class FakeRouter(FakeDevice):
+
+    kind = 'router'
+
+    def add_route(self):
+        return FakeRoute(self._api, router_id=self.dto.get('id'))
+
+    def get_routes(self):
+        return self._children('route', 'router_id')
+
+
+class FakeHostInterfacePort(FakeResource):
+
+    kind = 'host_interface_port'
+
+
+class FakeHost(FakeResource):
+
+    kind = 'host'
+
+    def add_host_interface_port(self):
+        return FakeHostInterfacePort(self._api, host_id=self.dto.get('id'))
+
+    def get_ports(self):
+        return self._children('host_interface_port', 'host_id')
+
+
+class FakeMidonetApi(object):
+    """Fake of midonetclient.api.MidonetApi.
+
+    calls counts the requests by 'METHOD kind', and latency seconds are slept
+    on each of them.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._resources = collections.defaultdict(collections.OrderedDict)
+        self._lock = threading.Lock()
+
+    # bookkeeping
+
+    def _request(self, method, kind):
+        with self._lock:
+            self.calls['%s %s' % (method, kind)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _store(self, resource):
+        self._resources[resource.kind][resource.dto['id']] = resource
+
+    def _discard(self, resource):
+        self._resources[resource.kind].pop(resource.dto['id'], None)
+
+    def _all(self, kind):
+        return list(self._resources[kind].values())
+
+    def _lookup(self, kind, id_):
+        try:
+            return self._resources[kind][id_]
+        except KeyError:
+            raise w_exc.HTTPNotFound('%s %s not found' % (kind, id_))
+
+    def _get(self, kind, id_):
+        self._request('GET', kind)
+        return self._lookup(kind, id_)
+
+    def _list(self, kind, query):
+        self._request('GET', kind + 's')
+        query = query or {}
+        return [r for r in self._all(kind)
+                if all(r.dto.get(k) == v for k, v in query.items())]
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    # MidonetApi
+
+    def get_chains(self, query=None):
+        return self._list('chain', query)
+
+    def get_chain(self, id_):
+        return self._get('chain', id_)
+
+    def add_chain(self):
+        return FakeChain(self)
+
+    def get_rule(self, id_):
+        return self._get('rule', id_)
+
+    def get_port_groups(self, query=None):
+        return self._list('port_group', query)
+
+    def get_port_group(self, id_):
+        return self._get('port_group', id_)
+
+    def add_port_group(self):
+        return FakePortGroup(self)
+
+    def get_bridges(self, query=None):
+        return self._list('bridge', query)
+
+    def get_bridge(self, id_):
+        return self._get('bridge', id_)
+
+    def add_bridge(self):
+        return FakeBridge(self)
+
+    def get_routers(self, query=None):
+        return self._list('router', query)
+
+    def get_router(self, id_):
+        return self._get('router', id_)
+
+    def add_router(self):
+        return FakeRouter(self)
+
+    def get_port(self, id_):
+        return self._get('port', id_)
+
+    def get_hosts(self, query=None):
+        return self._list('host', query)
+
+    def get_host(self, id_):
+        return self._get('host', id_)
+
+    def add_host(self, id_=None):
+        """Registers a host, as midolman would. Not a REST request."""
+        host = FakeHost(self, id=id_ or str(uuid.uuid4()))
+        self._store(host)
+        return host
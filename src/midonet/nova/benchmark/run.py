@@ -0,0 +1,319 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks the firewall driver and the security group handler against
+the fake MidoNet API, reporting the REST calls made and the wall time of
+each scenario.
+
+    python -m midonet.nova.benchmark.run --instances 200 --chains 5000 \\
+        --latency 0.005 boot_storm sg_churn mass_delete
+
+Options after -- are passed to nova's configuration, e.g.
+-- --config-file bench.conf to set [MIDONET] options.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import eventlet
+eventlet.monkey_patch()
+
+from eventlet import greenpool
+from oslo.config import cfg
+
+from midonet.nova.benchmark import fake_api
+from midonet.nova import midonet_connection
+from midonet.nova.network import midonet_lib
+from midonet.nova.network import reconciler
+from midonet.nova.network import rule_compiler
+from midonet.nova.network import sg
+
+
+TENANT_ID = 'bench-tenant'
+NET_CIDR = '10.0.0.0/8'
+
+CONF = cfg.CONF
+
+
+class FakeContext(object):
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+    def elevated(self):
+        return self
+
+    def to_dict(self):
+        return {'project_id': self.project_id}
+
+
+class FakeDb(object):
+    """The part of nova.db used by the security group code."""
+
+    def __init__(self):
+        self.groups = {}
+        self.rules = {}
+        self.instance_groups = {}
+        self._next_id = 1
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def add_group(self, project_id, name):
+        group = {'id': self._new_id(), 'name': name,
+                 'project_id': project_id}
+        self.groups[group['id']] = group
+        return group
+
+    def add_rule(self, group, port, cidr='0.0.0.0/0', protocol='tcp'):
+        rule = {'id': self._new_id(), 'parent_group_id': group['id'],
+                'protocol': protocol, 'from_port': port, 'to_port': port,
+                'cidr': cidr, 'group_id': None}
+        self.rules[rule['id']] = rule
+        return rule
+
+    def security_group_get(self, ctxt, group_id):
+        return self.groups[group_id]
+
+    def security_group_get_by_name(self, ctxt, project_id, name):
+        for g in self.groups.values():
+            if g['project_id'] == project_id and g['name'] == name:
+                return g
+
+    def security_group_get_all(self, ctxt):
+        return list(self.groups.values())
+
+    def security_group_get_by_project(self, ctxt, project_id):
+        return [dict(g, rules=self.security_group_rule_get_by_security_group(
+                    ctxt, g['id']))
+                for g in self.groups.values()
+                if g['project_id'] == project_id]
+
+    def security_group_get_by_instance(self, ctxt, instance_id):
+        return [self.groups[g] for g in self.instance_groups[instance_id]]
+
+    def security_group_rule_get(self, ctxt, rule_id):
+        return self.rules[rule_id]
+
+    def security_group_rule_get_by_security_group(self, ctxt, group_id):
+        return [r for r in self.rules.values()
+                if r['parent_group_id'] == group_id]
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.api = fake_api.FakeMidonetApi()
+        self.db = FakeDb()
+        self.ctxt = FakeContext(TENANT_ID)
+        self.instances = []
+
+        midonet_connection.mido_api = self.api
+        midonet_lib.db = self.db
+        sg.db = self.db
+        reconciler.db = self.db
+        self.firewall = sg.MidonetFirewallDriver(None)
+        self.handler = sg.MidonetSecurityGroupHandler()
+
+        # a populated tenant: unrelated chains and the default group
+        for i in range(args.chains):
+            self.api.add_chain().tenant_id(TENANT_ID)\
+                                .name('bench_chain_%d' % i).create()
+        self.bridge = self.api.add_bridge().tenant_id(TENANT_ID)\
+                                           .name('bench').create()
+        self.default_sg = self.db.add_group(TENANT_ID, 'default')
+        self.handler.trigger_security_group_create_refresh(self.ctxt,
+                                                           self.default_sg)
+        rules = [self.db.add_rule(self.default_sg, 22 + i)
+                 for i in range(args.rules)]
+        self.handler.trigger_security_group_rule_create_refresh(
+            self.ctxt, [r['id'] for r in rules])
+
+    def _spawn_all(self, func, items):
+        pool = greenpool.GreenPool(self.args.concurrency)
+        for item in items:
+            pool.spawn_n(func, item)
+        pool.waitall()
+
+    def _new_instances(self):
+        instances = []
+        first = len(self.db.instance_groups)
+        for i in range(first, first + self.args.instances):
+            port = self.bridge.add_port().create()
+            instance = {'id': i, 'uuid': 'instance-%d' % i,
+                        'project_id': TENANT_ID}
+            self.db.instance_groups[i] = [self.default_sg['id']]
+            network_info = [({'id': self.bridge.get_id(),
+                              'cidr': NET_CIDR},
+                             {'vif_uuid': port.get_id(),
+                              'mac': '02:00:00:%02x:%02x:%02x' % (
+                                  i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                              'ips': [{'ip': '10.%d.%d.%d' % (
+                                  i >> 16 & 0xff, i >> 8 & 0xff,
+                                  i & 0xff)}]})]
+            instances.append((instance, network_info))
+        return instances
+
+    def prepare_boot_storm(self):
+        self._booting = self._new_instances()
+
+    def boot_storm(self):
+        """Prepares the filters of many instances at once."""
+        self._spawn_all(
+            lambda pair: self.firewall.prepare_instance_filter(*pair),
+            self._booting)
+        self.instances.extend(self._booting)
+
+    def prepare_bulk_boot(self):
+        self._booting = self._new_instances()
+
+    def bulk_boot(self):
+        """Prepares the filters of many instances with one bulk call."""
+        self.firewall.prepare_instance_filters(self._booting)
+        self.instances.extend(self._booting)
+
+    def sg_churn(self):
+        """Creates a security group with many rules and deletes them."""
+        group = self.db.add_group(TENANT_ID, 'churn')
+        self.handler.trigger_security_group_create_refresh(self.ctxt, group)
+        rules = [self.db.add_rule(group, 1000 + i, '10.%d.0.0/16' % i)
+                 for i in range(self.args.churn_rules)]
+        self.handler.trigger_security_group_rule_create_refresh(
+            self.ctxt, [r['id'] for r in rules])
+        for r in rules:
+            del self.db.rules[r['id']]
+            self.handler.trigger_security_group_rule_destroy_refresh(
+                self.ctxt, [r['id']])
+        del self.db.groups[group['id']]
+        self.handler.trigger_security_group_destroy_refresh(self.ctxt,
+                                                            group['id'])
+
+    def mass_delete(self):
+        """Removes the filters of all the instances booted so far."""
+        self._spawn_all(
+            lambda pair: self.firewall.unfilter_instance(*pair),
+            self.instances)
+        self.instances = []
+
+    def bulk_delete(self):
+        """Removes the filters of all the instances with one bulk call."""
+        self.firewall.unfilter_instances(self.instances)
+        self.instances = []
+
+    def prepare_rule_compile(self):
+        rule_compiler.clear_cache()
+        protocols = ('tcp', 'udp', 'icmp', '47')
+        self._compiling = [
+            {'protocol': protocols[i % len(protocols)],
+             'from_port': i % 1024, 'to_port': i % 1024,
+             'cidr': '10.%d.0.0/16' % (i % 256)}
+            for i in range(self.args.compile_rules)]
+
+    def rule_compile(self):
+        """Translates many Nova rules without making any request."""
+        rule_compiler.compile_rules(self._compiling)
+
+    def prepare_reconcile(self):
+        self.reconciler = reconciler.Reconciler(self.api)
+        # drift: a lost rule, a stale rule and chain, a missing port group
+        chain = self.api.get_chains({'name': 'os_sg_default'})[0]
+        chain.get_rules()[0].delete()
+        chain.add_rule().type('accept').properties(
+            {midonet_lib.RuleManager.OS_SG_KEY: 'stale'}).create()
+        self.api.add_chain().tenant_id(TENANT_ID).name('os_sg_0_gone')\
+                            .create()
+        self.api.get_port_groups({'name': 'os_sg_default'})[0].delete()
+
+    def reconcile(self):
+        """Reconciles the tenant with the security groups in the database."""
+        self.reconciler.reconcile(self.ctxt, TENANT_ID)
+
+    def run(self, scenario):
+        prepare = getattr(self, 'prepare_' + scenario, None)
+        if prepare:
+            self.api.latency = 0.0
+            prepare()
+        self.api.latency = self.args.latency
+        self.api.reset_calls()
+        start = time.time()
+        getattr(self, scenario)()
+        elapsed = time.time() - start
+        return {'scenario': scenario,
+                'seconds': round(elapsed, 3),
+                'calls': self.api.total_calls(),
+                'by_operation': dict(self.api.calls)}
+
+
+SCENARIOS = ('boot_storm', 'bulk_boot', 'sg_churn', 'mass_delete',
+             'bulk_delete', 'reconcile', 'rule_compile')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark MidoNet security group workflows.')
+    parser.add_argument('scenarios', nargs='*',
+                        help=('scenarios to run in order, among %s' %
+                              ', '.join(SCENARIOS)))
+    parser.add_argument('--instances', type=int, default=100,
+                        help='instances booted by boot_storm')
+    parser.add_argument('--chains', type=int, default=1000,
+                        help='unrelated chains already in the tenant')
+    parser.add_argument('--rules', type=int, default=5,
+                        help='rules of the default security group')
+    parser.add_argument('--churn-rules', type=int, default=50,
+                        help='rules created and deleted by sg_churn')
+    parser.add_argument('--compile-rules', type=int, default=100000,
+                        help='rules translated by rule_compile')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds slept on every fake REST call')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='instances handled at the same time')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    argv = sys.argv[1:]
+    conf_argv = []
+    if '--' in argv:
+        conf_argv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    for s in args.scenarios:
+        if s not in SCENARIOS:
+            parser.error('unknown scenario %r' % s)
+    if not args.scenarios:
+        args.scenarios = list(SCENARIOS)
+    CONF(conf_argv, project='nova')
+
+    bench = Benchmark(args)
+    results = [bench.run(s) for s in args.scenarios]
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    for r in results:
+        print('%-12s %8.3fs %8d calls' % (r['scenario'], r['seconds'],
+                                          r['calls']))
+        for op, n in sorted(r['by_operation'].items()):
+            print('    %-24s %8d' % (op, n))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
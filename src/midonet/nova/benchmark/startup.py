@@ -0,0 +1,149 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measures what loading the MidoNet plugins costs a Nova service: the time
+to import the module of each driver and to construct it, and the modules
+this pulls in. Every measure is taken in a fresh interpreter.
+
+    python -m midonet.nova.benchmark.startup --repeat 5 firewall vif
+
+Options after -- are passed to nova's configuration as in
+midonet.nova.benchmark.run.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+# entry point -> (module, driver class, constructor arguments)
+ENTRY_POINTS = {
+    'firewall': ('midonet.nova.network.sg', 'MidonetFirewallDriver',
+                 (None,)),
+    'sg_handler': ('midonet.nova.network.sg', 'MidonetSecurityGroupHandler',
+                   ()),
+    'vif': ('midonet.nova.virt.libvirt.vif', 'MidonetVifDriver', ()),
+}
+
+# modules a Nova service has loaded before it loads the plugins
+BASELINE_MODULES = ('oslo.config.cfg', 'nova.openstack.common.log',
+                    'nova.context', 'nova.db')
+
+# packages and modules the plugins should only load once they talk to MidoNet
+HEAVY_MODULES = ('nova.compute.api', 'midonetclient', 'pyroute2')
+
+
+def _is_heavy(module):
+    return any(module == m or module.startswith(m + '.')
+               for m in HEAVY_MODULES)
+
+
+def _measure(entry, conf_argv):
+    """Runs in the child interpreter."""
+    import eventlet
+    eventlet.monkey_patch()
+    for name in BASELINE_MODULES:
+        __import__(name)
+
+    from oslo.config import cfg
+    module_name, class_name, args = ENTRY_POINTS[entry]
+    before = set(sys.modules)
+
+    start = time.time()
+    __import__(module_name)
+    imported = time.time()
+    cfg.CONF(conf_argv, project='nova')
+    configured = time.time()
+    getattr(sys.modules[module_name], class_name)(*args)
+    constructed = time.time()
+
+    from midonet.nova import midonet_connection
+    loaded = set(sys.modules) - before
+    return {'entry': entry,
+            'import_seconds': imported - start,
+            'init_seconds': constructed - configured,
+            'modules': len(loaded),
+            'heavy_modules': sorted(m for m in loaded if _is_heavy(m)),
+            'api_created': midonet_connection.mido_api is not None}
+
+
+def run_child(entry, conf_argv):
+    cmd = [sys.executable, '-m', 'midonet.nova.benchmark.startup',
+           '--child', entry, '--'] + conf_argv
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def summarize(samples):
+    samples = sorted(samples, key=lambda s: s['import_seconds'] +
+                     s['init_seconds'])
+    result = dict(samples[len(samples) // 2])
+    result['runs'] = len(samples)
+    result['min_seconds'] = (samples[0]['import_seconds'] +
+                             samples[0]['init_seconds'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the import and construction of MidoNet drivers.')
+    parser.add_argument('entries', nargs='*',
+                        help=('entry points to measure, among %s' %
+                              ', '.join(sorted(ENTRY_POINTS))))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='fresh interpreters started per entry point')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    argv = sys.argv[1:]
+    conf_argv = []
+    if '--' in argv:
+        conf_argv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_measure(args.child, conf_argv)))
+        return
+
+    for e in args.entries:
+        if e not in ENTRY_POINTS:
+            parser.error('unknown entry point %r' % e)
+    if not args.entries:
+        args.entries = sorted(ENTRY_POINTS)
+
+    results = [summarize([run_child(e, conf_argv)
+                          for i in range(max(args.repeat, 1))])
+               for e in args.entries]
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    # the median run is shown
+    for r in results:
+        print('%-12s import %7.3fs  init %7.3fs  %4d modules  api %s' % (
+            r['entry'], r['import_seconds'], r['init_seconds'],
+            r['modules'], 'created' if r['api_created'] else 'deferred'))
+        if r['heavy_modules']:
+            print('    loaded %s' % ', '.join(r['heavy_modules']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,11 +15,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+
 from oslo.config import cfg
 
 from nova.openstack.common import log as logging
 
-from midonetclient import api
+from midonet.nova import api_stats
 
 LOG = logging.getLogger('nova...' + __name__)
 
@@ -54,14 +56,35 @@ midonet_opts = [
 CONF = cfg.CONF
 CONF.register_opts(midonet_opts, 'MIDONET')
 mido_api = None
+_mido_api_lock = threading.Lock()
+
+
+def _new_mido_api():
+    # midonetclient is only imported by processes talking to MidoNet
+    from midonetclient import api
+    return api.MidonetApi(CONF.MIDONET.midonet_uri,
+                          CONF.MIDONET.username,
+                          CONF.MIDONET.password,
+                          CONF.MIDONET.project_id)
 
 
 def get_mido_api():
     global mido_api
-    if mido_api == None:
-        mido_api = api.MidonetApi(CONF.MIDONET.midonet_uri,
-                                  CONF.MIDONET.username,
-                                  CONF.MIDONET.password,
-                                  CONF.MIDONET.project_id)
+    with _mido_api_lock:
+        if mido_api == None:
+            api = _new_mido_api()
+            if CONF.MIDONET.api_stats:
+                api = api_stats.instrument(api)
+            mido_api = api
 
     return mido_api
+
+
+class LazyMidonetApi(object):
+    """Stands for the object returned by get_mido_api(), which is only
+    called when a MidoNet request is first made. Drivers keep one from their
+    constructor so that services never talking to MidoNet do not set it up.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_mido_api(), name)
@@ -15,16 +15,101 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+from eventlet import greenpool
+from webob import exc as w_exc
+
+from oslo.config import cfg
+
 from nova import context
 from nova import db
+from nova import exception
 from nova.openstack.common import log as logging
-from nova.compute import api as compute_api
 
-import midonetclient.port_type as PortType
+from midonet.nova import api_stats
+from midonet.nova.network import rule_compiler
+from midonet.nova.network import rule_optimizer
 
 
 LOG = logging.getLogger('nova...' + __name__)
 
+midonet_lib_opts = [
+    cfg.IntOpt('resource_cache_ttl',
+               default=30,
+               help=('Seconds a cached per-tenant listing of MidoNet '
+                     'resources stays valid. 0 disables caching.')),
+    cfg.IntOpt('resource_cache_tenants',
+               default=256,
+               help=('Maximum number of tenants whose MidoNet resource '
+                     'listings are cached. The least recently used tenant '
+                     'is evicted first.')),
+    cfg.IntOpt('sg_cache_ttl',
+               default=10,
+               help=('Seconds the security groups looked up in Nova while '
+                     'creating rules are reused, keyed by security group '
+                     'id. 0 disables caching.')),
+    cfg.BoolOpt('rule_index_preload',
+                default=False,
+                help=('Index the MidoNet rules of all security group chains '
+                      'when the security group handler first deletes rules, '
+                      'so that rule deletion does not scan the chains.')),
+    cfg.BoolOpt('shared_vif_chains',
+                default=False,
+                help=('Keep the rules that do not depend on the VIF, i.e. '
+                      'same network, return flow and fall back rules, in a '
+                      'chain shared by all VIFs of a network instead of '
+                      'copying them to every VIF chain. The shared chain '
+                      'keeps the allow_same_net_traffic setting and network '
+                      'CIDR it was created with and is not deleted with the '
+                      'last VIF of the network; delete the os_sg_net_<id>_out '
+                      'chain to have it created again after changing '
+                      'them.')),
+    cfg.BoolOpt('optimize_sg_rules',
+                default=False,
+                help=('Merge the rules of a security group created together '
+                      'into fewer MidoNet rules: adjacent CIDRs and port '
+                      'ranges are merged and rules covered by others are '
+                      'dropped.')),
+    cfg.IntOpt('vif_rule_concurrency',
+               default=1,
+               help=('Maximum number of concurrent MidoNet API requests '
+                     'made while setting up the rules of a VIF. 1 makes '
+                     'them one after another.')),
+    cfg.IntOpt('bulk_filter_concurrency',
+               default=1,
+               help=('Number of instances whose filters are set up at the '
+                     'same time by MidonetFirewallDriver.'
+                     'prepare_instance_filters.')),
+    cfg.IntOpt('bulk_delete_concurrency',
+               default=1,
+               help=('Maximum number of concurrent chain deletions when the '
+                     'filters of instances are removed.')),
+    cfg.BoolOpt('warm_up_caches',
+                default=False,
+                help=('Fetch in the background, when the firewall and VIF '
+                      'drivers start, the chains and port groups of the '
+                      'tenants having instances on this host and the MidoNet '
+                      'host resource, so that the first VIF operations after '
+                      'a restart do not wait for these listings.')),
+    cfg.IntOpt('warm_up_concurrency',
+               default=4,
+               help=('Maximum number of tenants whose chains and port '
+                     'groups are fetched at the same time when warming up.')),
+    cfg.IntOpt('router_chain_concurrency',
+               default=1,
+               help=('Maximum number of concurrent chain creations when the '
+                     'in and out chains of routers are created.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(midonet_lib_opts, 'MIDONET')
+CONF.import_opt('host', 'nova.netconf')
+
 PREFIX = 'os_sg_'
 SUFFIX_IN = '_in'
 SUFFIX_OUT = '_out'
@@ -43,34 +128,317 @@ chain_name = sg_label
 port_group_name = sg_label
 
 
+def run_concurrently(tasks, concurrency, return_exceptions=False):
+    """Calls the callables on at most concurrency greenthreads at a time and
+       returns their results in order. With a concurrency of 1 they are called
+       one after another in the calling thread.
+
+       Unless return_exceptions is set, the first exception raised by a task
+       is re-raised once all tasks have finished; otherwise exceptions are
+       returned in place of the results.
+    """
+    if concurrency <= 1 or len(tasks) <= 1:
+        spawned = [_CalledTask(t) for t in tasks]
+    else:
+        pool = greenpool.GreenPool(concurrency)
+        # the greenthreads do not see the caller tag of this one
+        spawned = [pool.spawn(_CalledTask, api_stats.propagate_caller(t))
+                   for t in tasks]
+        pool.waitall()
+        spawned = [gt.wait() for gt in spawned]
+
+    results = []
+    for task in spawned:
+        if task.error is not None and not return_exceptions:
+            raise task.error
+        results.append(task.error if task.error is not None else task.result)
+    return results
+
+
+def tenants_on_host(host=None):
+    """Returns the ids of the tenants having instances on the host, this
+       host if None.
+    """
+    # nova-compute may not access the database; objects go through the
+    # conductor there
+    from nova.objects import instance as instance_obj
+    ctxt = context.get_admin_context()
+    instances = instance_obj.InstanceList.get_by_host(ctxt,
+                                                      host or CONF.host)
+    return sorted(set(i['project_id'] for i in instances))
+
+
+def warm_up_in_background(name, func):
+    """Calls func in a daemon thread so that the service serves meanwhile.
+       A failure is only logged; the caches are then filled on first use.
+    """
+    def run():
+        start = time.time()
+        try:
+            func()
+        except Exception:
+            LOG.exception('Failed to warm up %s', name)
+            return
+        LOG.info('warmed up %s in %.3fs', name, time.time() - start)
+
+    t = threading.Thread(target=run, name='midonet-warm-up-%s' % name)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class _CalledTask:
+
+    def __init__(self, task):
+        self.result = None
+        self.error = None
+        try:
+            self.result = task()
+        except Exception as e:
+            LOG.debug('task=%r failed', task, exc_info=True)
+            self.error = e
+
+
+class ResourceIndex:
+    """Per-tenant index of MidoNet resources keyed by name.
+
+    The listing of a tenant is fetched with list_func(tenant_id) on first use
+    and kept for ttl seconds. At most max_tenants listings are kept, the
+    least recently used one being evicted first. A lookup that misses on a
+    cached listing refetches it once, so a resource created by another
+    process is not hidden by a stale entry.
+    """
+
+    def __init__(self, list_func, ttl=None, max_tenants=None):
+        self._list_func = list_func
+        if ttl is None:
+            ttl = CONF.MIDONET.resource_cache_ttl
+        if max_tenants is None:
+            max_tenants = CONF.MIDONET.resource_cache_tenants
+        self.ttl = ttl
+        self.max_tenants = max(max_tenants, 1)
+        self._tenants = collections.OrderedDict()
+        self._loading = {}
+        self._held = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _load(self, tenant_id):
+        by_name = {}
+        for r in self._list_func(tenant_id):
+            by_name[r.get_name()] = r
+        return by_name
+
+    def _get_tenant(self, tenant_id, refresh=False):
+        """Returns a tuple of the name dictionary for the tenant and whether
+           it has just been fetched. Concurrent callers share one fetch.
+        """
+        with self._lock:
+            entry = self._tenants.pop(tenant_id, None)
+            if entry and not refresh and (entry[0] > time.time() or
+                                          self._held[tenant_id]):
+                self._tenants[tenant_id] = entry
+                return entry[1], False
+            loading = self._loading.get(tenant_id)
+            if loading is None:
+                loading = self._loading[tenant_id] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            loading.wait()
+            with self._lock:
+                entry = self._tenants.get(tenant_id)
+            if entry:
+                return entry[1], True
+            # the fetch we waited for failed; try on our own
+
+        LOG.debug('loading index for tenant_id=%r', tenant_id)
+        try:
+            by_name = self._load(tenant_id)
+            with self._lock:
+                self._tenants.pop(tenant_id, None)
+                self._tenants[tenant_id] = (time.time() + self.ttl, by_name)
+                while len(self._tenants) > self.max_tenants:
+                    self._tenants.popitem(last=False)
+        finally:
+            if owner:
+                with self._lock:
+                    del self._loading[tenant_id]
+                loading.set()
+        return by_name, True
+
+    def load(self, tenant_id):
+        """Fetches the listing of the tenant unless a valid one is cached."""
+        self._get_tenant(tenant_id)
+
+    def hold(self, tenant_id):
+        """Keeps the listing of the tenant valid whatever its age, until
+           release() is called as many times.
+        """
+        with self._lock:
+            self._held[tenant_id] += 1
+
+    def release(self, tenant_id):
+        with self._lock:
+            self._held[tenant_id] -= 1
+            if self._held[tenant_id] <= 0:
+                del self._held[tenant_id]
+
+    def get(self, tenant_id, name, refresh_on_miss=True):
+        """Returns the resource named name or None."""
+        by_name, fresh = self._get_tenant(tenant_id)
+        if name not in by_name and refresh_on_miss and not fresh:
+            by_name, fresh = self._get_tenant(tenant_id, refresh=True)
+        return by_name.get(name)
+
+    def find_prefix(self, tenant_id, prefix, refresh_on_miss=True):
+        """Returns the resources whose names start with prefix."""
+        by_name, fresh = self._get_tenant(tenant_id)
+        found = [r for n, r in by_name.items() if n.startswith(prefix)]
+        if not found and refresh_on_miss and not fresh:
+            by_name, fresh = self._get_tenant(tenant_id, refresh=True)
+            found = [r for n, r in by_name.items() if n.startswith(prefix)]
+        return found
+
+    def refresh(self, tenant_id):
+        """Fetches the listing of the tenant regardless of its age."""
+        self._get_tenant(tenant_id, refresh=True)
+
+    def add(self, tenant_id, resource):
+        """Records a resource created by this process."""
+        with self._lock:
+            entry = self._tenants.get(tenant_id)
+            if entry:
+                entry[1][resource.get_name()] = resource
+
+    def remove(self, tenant_id, name):
+        """Forgets a resource deleted by this process."""
+        with self._lock:
+            entry = self._tenants.get(tenant_id)
+            if entry:
+                entry[1].pop(name, None)
+
+    def invalidate(self, tenant_id=None):
+        """Drops the listing of the tenant, or of all tenants if None."""
+        with self._lock:
+            if tenant_id is None:
+                self._tenants.clear()
+            else:
+                self._tenants.pop(tenant_id, None)
+
+
+class LookupCache:
+    """Results of lookups keyed by any hashable, kept for ttl seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns the cached value of key, calling load() to get it if it
+           is missing or expired.
+        """
+        if self.ttl <= 0:
+            return load()
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        value = load()
+        self.put(key, value)
+        return value
+
+    def peek(self, key):
+        """Returns the cached value of key or None if missing or expired."""
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, match=None):
+        """Drops the entries whose key match(key) is true, or all of them if
+           match is None.
+        """
+        with self._lock:
+            if match is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if match(k)]:
+                del self._entries[key]
+
+
 class ChainManager:
 
     TENANT_ROUTER_IN = 'os_project_router_in'
     TENANT_ROUTER_OUT = 'os_project_router_out'
 
-    def __init__(self, mido_api):
+    def __init__(self, mido_api, chain_index=None):
         self.mido_api = mido_api
+        if chain_index is None:
+            chain_index = ResourceIndex(self._list_chains)
+        self.chain_index = chain_index
+        # (tenant_id, router_id) -> {'in': chain, 'out': chain}
+        self.router_chains = LookupCache(chain_index.ttl)
+
+    def _list_chains(self, tenant_id):
+        return self.mido_api.get_chains({'tenant_id': tenant_id})
 
     def _chain_name_for_vif(self, vif_uuid, direction):
         global PREFIX
         return PREFIX + 'vif_' + vif_uuid + '_' + direction
 
+    def _chain_name_for_network(self, network_id, direction):
+        return PREFIX + 'net_' + network_id + '_' + direction
+
+    def _create_chain(self, tenant_id, name):
+        chain = self.mido_api.add_chain().tenant_id(tenant_id)\
+                                         .name(name)\
+                                         .create()
+        self.chain_index.add(tenant_id, chain)
+        return chain
+
+    def _delete_chain(self, tenant_id, chain):
+        LOG.debug('deleting chain=%r', chain)
+        chain.delete()
+        self.chain_index.remove(tenant_id, chain.get_name())
+        if self._is_router_chain_name(chain.get_name()):
+            self.router_chains.invalidate(lambda k: k[0] == tenant_id)
+
+    def get_by_name(self, tenant_id, name):
+        """Returns the chain of the tenant with the given name or None."""
+        return self.chain_index.get(tenant_id, name)
+
+    def invalidate(self, tenant_id=None):
+        """Drops cached chains of the tenant, or of all tenants if None."""
+        self.chain_index.invalidate(tenant_id)
+        if tenant_id is None:
+            self.router_chains.invalidate()
+        else:
+            self.router_chains.invalidate(lambda k: k[0] == tenant_id)
+
     def create_for_sg(self, tenant_id, sg_id, sg_name):
         LOG.debug('tenant_id=%r, sg_id=%r, sg_name=%r', tenant_id, sg_id,
                   sg_name)
 
         cname = chain_name(sg_id, sg_name)
-        self.mido_api.add_chain().tenant_id(tenant_id).name(cname).create()
+        self._create_chain(tenant_id, cname)
 
     def delete_for_sg(self, tenant_id, sg_id):
+        """Deletes the chains of the security group and returns them."""
         LOG.debug('tenant_id=%r, sg_id=%r', tenant_id, sg_id)
 
         chain_name_prefix = chain_name(sg_id, '')
-        chains = self.mido_api.get_chains({'tenant_id': tenant_id})
+        chains = self.chain_index.find_prefix(tenant_id, chain_name_prefix)
         for c in chains:
-            if c.get_name().startswith(chain_name_prefix):
-                LOG.debug('deleting chain=%r', c)
-                c.delete()
+            self._delete_chain(tenant_id, c)
+        return chains
 
     def create_for_vif(self, tenant_id, vif_id):
         """Create chains for the vif and returns a dictionary that
@@ -78,24 +446,20 @@ class ChainManager:
         """
         LOG.debug('tenant_id=%r, vif_id=%r', tenant_id, vif_id)
 
-        # see if there are already there
-        chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-        for c in chains:
-            if c.get_name().startswith(self._chain_name_for_vif(vif_id, '')):
-                assert False, 'chain for vif should not be there'
+        # see if there are already there. VIF chains are only created here,
+        # so the cached listing is trusted without refetching on a miss.
+        if self.chain_index.find_prefix(tenant_id,
+                                        self._chain_name_for_vif(vif_id, ''),
+                                        refresh_on_miss=False):
+            assert False, 'chain for vif should not be there'
 
         # create a inbound chain
-        in_chain = self.mido_api.add_chain()\
-                                 .tenant_id(tenant_id)\
-                                 .name(self._chain_name_for_vif(vif_id, 'in'))\
-                                 .create()
+        in_chain = self._create_chain(tenant_id,
+                                      self._chain_name_for_vif(vif_id, 'in'))
 
         # create a outbound chain
-        out_chain = self.mido_api\
-                .add_chain()\
-                .tenant_id(tenant_id)\
-                .name(self._chain_name_for_vif(vif_id, 'out'))\
-                .create()
+        out_chain = self._create_chain(tenant_id,
+                                       self._chain_name_for_vif(vif_id, 'out'))
 
         return {'in': in_chain, 'out': out_chain}
 
@@ -104,10 +468,97 @@ class ChainManager:
            are cascade deleted.
         """
         LOG.debug('tenant_id=%r, vif_id=%r', tenant_id, vif_id)
-        chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-        for c in chains:
-            if c.get_name().startswith(self._chain_name_for_vif(vif_id, '')):
-                c.delete()
+        for c in self.chain_index.find_prefix(
+                tenant_id, self._chain_name_for_vif(vif_id, '')):
+            self._delete_chain(tenant_id, c)
+
+    def delete_for_vifs(self, tenant_id, vif_ids, concurrency=None):
+        """Deletes the in and out chains of many VIFs of the tenant, with at
+           most concurrency deletions at a time. Chains already gone are
+           ignored. Returns a dictionary of the errors keyed by VIF id, so
+           that the caller can retry them.
+        """
+        LOG.debug('tenant_id=%r, vif_ids=%r', tenant_id, vif_ids)
+        if concurrency is None:
+            concurrency = CONF.MIDONET.bulk_delete_concurrency
+
+        def find_chains():
+            found, missing = [], False
+            for vif_id in vif_ids:
+                for direction in ('in', 'out'):
+                    c = self.chain_index.get(
+                        tenant_id, self._chain_name_for_vif(vif_id, direction),
+                        refresh_on_miss=False)
+                    if c:
+                        found.append((vif_id, c))
+                    else:
+                        missing = True
+            return found, missing
+
+        chains, missing = find_chains()
+        if missing:
+            # refetch once for the whole batch rather than once per VIF
+            self.chain_index.refresh(tenant_id)
+            chains, missing = find_chains()
+
+        def delete(chain):
+            try:
+                self._delete_chain(tenant_id, chain)
+            except w_exc.HTTPNotFound:
+                self.chain_index.remove(tenant_id, chain.get_name())
+
+        results = run_concurrently(
+            [functools.partial(delete, c) for vif_id, c in chains],
+            concurrency, return_exceptions=True)
+
+        errors = {}
+        for (vif_id, c), result in zip(chains, results):
+            if isinstance(result, Exception):
+                LOG.warn('Failed to delete chain=%r of vif=%r: %r', c, vif_id,
+                         result)
+                errors[vif_id] = result
+        return errors
+
+    def get_for_vif(self, tenant_id, vif_id, direction):
+        """Returns the in or out chain of the VIF or None."""
+        return self.chain_index.get(
+            tenant_id, self._chain_name_for_vif(vif_id, direction))
+
+    def get_for_network(self, tenant_id, network_id, direction):
+        """Returns the chain shared by the VIFs of the network or None."""
+        return self.chain_index.get(
+            tenant_id, self._chain_name_for_network(network_id, direction))
+
+    def create_for_network(self, tenant_id, network_id, direction):
+        """Creates the chain shared by the VIFs of the network."""
+        LOG.debug('tenant_id=%r, network_id=%r, direction=%r', tenant_id,
+                  network_id, direction)
+        return self._create_chain(
+            tenant_id, self._chain_name_for_network(network_id, direction))
+
+    def keep_one(self, tenant_id, chain):
+        """Returns the chain to use among those of the tenant named like
+           chain, which other hosts may have created at the same time. They
+           all keep the one with the lowest id; chain is deleted if it is
+           not that one.
+        """
+        same = [c for c in self._list_chains(tenant_id)
+                if c.get_name() == chain.get_name()]
+        winner = min(same + [chain], key=lambda c: c.get_id())
+        if winner.get_id() != chain.get_id():
+            LOG.debug('chain=%r was created elsewhere too, using id=%r',
+                      chain, winner.get_id())
+            self._delete_chain(tenant_id, chain)
+            self.chain_index.add(tenant_id, winner)
+        return winner
+
+    def delete_for_network(self, tenant_id, network_id, direction):
+        """Deletes the chain shared by the VIFs of the network."""
+        LOG.debug('tenant_id=%r, network_id=%r, direction=%r', tenant_id,
+                  network_id, direction)
+        chain = self.get_for_network(tenant_id, network_id, direction)
+        if chain:
+            self._delete_chain(tenant_id, chain)
 
     def get_router_chains(self, tenant_id, router_id):
         """
@@ -115,14 +566,18 @@ class ChainManager:
         and 'out' respectively, given the tenant_id and the router_id passed
         in in the arguments.
         """
+        chains = self.router_chains.peek((tenant_id, router_id))
+        if chains is not None:
+            return dict(chains)
 
         router_chain_names = self._get_router_chain_names(router_id)
         chains = {}
-        for c in  self.mido_api.get_chains({'tenant_id': tenant_id}):
-            if c.get_name() == router_chain_names['in']:
-                chains['in'] = c
-            elif c.get_name() == router_chain_names['out']:
-                chains['out'] = c
+        for direction in ('in', 'out'):
+            c = self.chain_index.get(tenant_id, router_chain_names[direction])
+            if c:
+                chains[direction] = c
+        if len(chains) == 2:
+            self.router_chains.put((tenant_id, router_id), dict(chains))
         return chains
 
     def create_router_chains(self, tenant_id, router_id):
@@ -130,19 +585,67 @@ class ChainManager:
         Creates chains for the router and returns the same dictionary as
         get_router_chains() returns.
         """
-        chains = {}
         router_chain_names = self._get_router_chain_names(router_id)
-        chains['in'] = self.mido_api.add_chain()\
-                           .tenant_id(tenant_id)\
-                           .name(router_chain_names['in'])\
-                           .create()
-
-        chains['out'] = self.mido_api.add_chain()\
-                            .tenant_id(tenant_id)\
-                            .name(router_chain_names['out'])\
-                            .create()
+        in_chain, out_chain = run_concurrently(
+            [functools.partial(self._create_chain, tenant_id,
+                               router_chain_names[d]) for d in ('in', 'out')],
+            CONF.MIDONET.router_chain_concurrency)
+        chains = {'in': in_chain, 'out': out_chain}
+        self.router_chains.put((tenant_id, router_id), dict(chains))
         return chains
 
+    def ensure_router_chains(self, tenant_id, router_ids, concurrency=None):
+        """Makes sure the in and out chains of the routers exist, creating
+           the missing ones with at most concurrency creations at a time.
+           The chains of the tenant are listed at most once. Returns a
+           dictionary of the get_router_chains() dictionaries keyed by
+           router id.
+        """
+        LOG.debug('tenant_id=%r, router_ids=%r', tenant_id, router_ids)
+        if concurrency is None:
+            concurrency = CONF.MIDONET.router_chain_concurrency
+
+        result = {}
+        for router_id in router_ids:
+            chains = self.router_chains.peek((tenant_id, router_id))
+            if chains is not None:
+                result[router_id] = dict(chains)
+
+        def find_chains():
+            missing = []
+            for router_id in router_ids:
+                if router_id in result:
+                    continue
+                names = self._get_router_chain_names(router_id)
+                chains = result.setdefault(router_id, {})
+                for direction in ('in', 'out'):
+                    c = self.chain_index.get(tenant_id, names[direction],
+                                             refresh_on_miss=False)
+                    if c:
+                        chains[direction] = c
+                    else:
+                        missing.append((router_id, direction))
+            return missing
+
+        missing = find_chains()
+        if missing:
+            # refetch once for all routers rather than once per chain
+            self.chain_index.refresh(tenant_id)
+            for router_id in set(r for r, d in missing):
+                del result[router_id]
+            missing = find_chains()
+
+        created = run_concurrently(
+            [functools.partial(self._create_chain, tenant_id,
+                               self._get_router_chain_names(r)[d])
+             for r, d in missing], concurrency)
+        for (router_id, direction), chain in zip(missing, created):
+            result[router_id][direction] = chain
+
+        for router_id, chains in result.items():
+            self.router_chains.put((tenant_id, router_id), dict(chains))
+        return result
+
     def _get_router_chain_names(self, router_id):
 
         in_name = OS_ROUTER_IN_CHAIN_NAME_FORMAT % router_id
@@ -150,147 +653,367 @@ class ChainManager:
         router_chain_names = {'in': in_name, 'out': out_name}
         return router_chain_names
 
+    def _is_router_chain_name(self, name):
+        return (name.startswith(OS_ROUTER_IN_CHAIN_NAME_FORMAT % '') or
+                name.startswith(OS_ROUTER_OUT_CHAIN_NAME_FORMAT % ''))
+
 
 class PortGroupManager:
 
-    def __init__(self, mido_api):
+    def __init__(self, mido_api, pg_index=None):
         self.mido_api = mido_api
+        if pg_index is None:
+            pg_index = ResourceIndex(self._list_port_groups)
+        self.pg_index = pg_index
+
+    def _list_port_groups(self, tenant_id):
+        return self.mido_api.get_port_groups({'tenant_id': tenant_id})
+
+    def get_by_name(self, tenant_id, name):
+        """Returns the port group of the tenant with the given name or None.
+        """
+        return self.pg_index.get(tenant_id, name)
+
+    def get_for_sg(self, tenant_id, sg_id):
+        """Returns the port groups named after the security group id."""
+        return self.pg_index.find_prefix(tenant_id,
+                                         port_group_name(sg_id, ''))
+
+    def invalidate(self, tenant_id=None):
+        """Drops cached port groups of the tenant, or of all tenants if None.
+        """
+        self.pg_index.invalidate(tenant_id)
 
     def create(self, tenant_id, sg_id, sg_name):
         LOG.debug('tenant_id=%r, sg_id=%r, sg_name=%r', tenant_id, sg_id,
                   sg_name)
         pg_name = port_group_name(sg_id, sg_name)
-        self.mido_api.add_port_group().tenant_id(tenant_id).name(
+        pg = self.mido_api.add_port_group().tenant_id(tenant_id).name(
             pg_name).create()
+        self.pg_index.add(tenant_id, pg)
 
     def delete(self, tenant_id, sg_id, sg_name):
         LOG.debug('tenant_id=%r, sg_id=%r, sg_name=%r', tenant_id, sg_id,
                   sg_name)
         pg_name_prefix = port_group_name(sg_id, sg_name)
-        pgs = self.mido_api.get_port_groups({'tenant_id': tenant_id})
-        for pg in pgs:
-            if pg.get_name().startswith(pg_name_prefix):
-                LOG.debug('deleting port group=%r', pg)
-                pg.delete()
+        for pg in self.pg_index.find_prefix(tenant_id, pg_name_prefix):
+            LOG.debug('deleting port group=%r', pg)
+            pg.delete()
+            self.pg_index.remove(tenant_id, pg.get_name())
+
+
+def is_sg_chain_name(name):
+    """Tells if the chain name is of a chain holding security group rules."""
+    return (name.startswith(PREFIX) and
+            not name.startswith(PREFIX + 'vif_') and
+            not name.startswith(PREFIX + 'net_'))
+
+
+def nova_rule_ids(mido_rule):
+    """Returns the ids of the Nova rules a MidoNet rule was created for."""
+    return rule_optimizer.split_ids(
+        (mido_rule.get_properties() or {}).get(RuleManager.OS_SG_KEY))
+
+
+class RuleIndex:
+    """Maps Nova security group rule ids to the MidoNet rules created for
+    them, so that a rule can be deleted without scanning the chains.
+
+    The index lives as long as the process. rebuild() fills it from the
+    os_sg_rule_id property of the rules in security group chains. A MidoNet
+    rule standing for several Nova rules is indexed under each of them.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        self._lock = threading.Lock()
+
+    def add(self, rule_id, mido_rule):
+        with self._lock:
+            self._rules[str(rule_id)] = mido_rule
+
+    def get(self, rule_id):
+        return self._rules.get(str(rule_id))
+
+    def pop(self, rule_id):
+        with self._lock:
+            return self._rules.pop(str(rule_id), None)
+
+    def remove_chain(self, chain_id):
+        """Forgets the rules of a deleted chain."""
+        with self._lock:
+            for rule_id in [k for k, r in self._rules.items()
+                            if r.get_chain_id() == chain_id]:
+                del self._rules[rule_id]
+
+    def rebuild(self, chains):
+        """Replaces the index with the rules found in the given chains.
+           Returns the number of rules indexed.
+        """
+        rules = {}
+        for c in chains:
+            if not is_sg_chain_name(c.get_name()):
+                continue
+            for r in c.get_rules():
+                for rule_id in nova_rule_ids(r):
+                    rules[rule_id] = r
+        with self._lock:
+            self._rules = rules
+        return len(rules)
 
 
 class RuleManager:
 
     OS_SG_KEY = 'os_sg_rule_id'
 
-    def __init__(self, mido_api, virtapi=None):
+    def __init__(self, mido_api, virtapi=None, chain_manager=None,
+                 pg_manager=None, rule_index=None):
         self.mido_api = mido_api
         self.virtapi = virtapi
-        if virtapi:
-            self.security_group_api = compute_api.SecurityGroupAPI()
+        self._security_group_api = None
+
+        if chain_manager is None:
+            chain_manager = ChainManager(self.mido_api)
+        self.chain_manager = chain_manager
+        if pg_manager is None:
+            pg_manager = PortGroupManager(self.mido_api)
+        self.pg_manager = pg_manager
+        if rule_index is None:
+            rule_index = RuleIndex()
+        self.rule_index = rule_index
+        self._shared_chain_lock = threading.Lock()
+        # Nova security groups keyed by ('group', id)
+        self.sg_cache = LookupCache(CONF.MIDONET.sg_cache_ttl)
+
+    def invalidate_security_group(self, sg_id=None):
+        """Drops the cached definition of the security group, or of all
+           security groups if None.
+        """
+        if sg_id is None:
+            self.sg_cache.invalidate()
+        else:
+            self.sg_cache.invalidate(lambda key: key[1] == sg_id)
 
-        self.chain_manager = ChainManager(self.mido_api)
-        self.pg_manager = PortGroupManager(self.mido_api)
+    def rebuild_rule_index(self, tenant_id=None):
+        """Fills the rule index from the security group chains of the tenant,
+           or of all tenants if None, with a single listing of the chains.
+        """
+        query = {}
+        if tenant_id is not None:
+            query['tenant_id'] = tenant_id
+        count = self.rule_index.rebuild(self.mido_api.get_chains(query))
+        LOG.info('indexed %d security group rules', count)
+
+    def _get_security_group_api(self):
+        if self._security_group_api is None:
+            # nova.compute.api is slow to import and only needed here
+            from nova.compute import api as compute_api
+            self._security_group_api = compute_api.SecurityGroupAPI()
+        return self._security_group_api
 
     def _properties(self, os_sg_rule_id):
         return {self.OS_SG_KEY: str(os_sg_rule_id)}
 
+    def _get_security_group(self, ctxt, sg_id):
+        def load():
+            if self.virtapi:
+                return self._get_security_group_api().get(ctxt, id=sg_id)
+            else:
+                return db.security_group_get(ctxt, sg_id)
+        return self.sg_cache.get(('group', sg_id), load)
+
     def create_for_sg(self, tenant_id, sg_id, sg_name, rule):
-        LOG.debug('sg_ig=%r, sg_name=%r', sg_id, sg_name)
-        LOG.debug('parent_group_id=%r', rule['parent_group_id'])
-        LOG.debug('protocol=%r', rule['protocol'])
-        LOG.debug('from_port=%r', rule['from_port'])
-        LOG.debug('to_port=%r', rule['to_port'])
-        LOG.debug('cidr=%r', rule['cidr'])
+        self.create_for_sg_rules(tenant_id, sg_id, sg_name, [rule])
+
+    def create_for_sg_rules(self, tenant_id, sg_id, sg_name, rules):
+        """Creates MidoNet rules for rules of a security group. The chain and
+           the port groups of source groups are looked up once for all rules.
+        """
+        LOG.debug('sg_ig=%r, sg_name=%r, rules=%d', sg_id, sg_name,
+                  len(rules))
+
+        if CONF.MIDONET.optimize_sg_rules:
+            rules = rule_optimizer.optimize(rules)
+            LOG.debug('optimized to %d rules', len(rules))
+
+        # translate all the rules before making any request
+        compiled = rule_compiler.compile_rules(rules)
 
         cname = chain_name(sg_id, sg_name)
 
         # search for the chain to put rules
-        chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-        found = False
-        for c in chains:
-            if c.get_name() == cname:
-                sg_chain = c
-                found = True
-        assert found
-        LOG.debug('putting a rule to the chain id=%r', sg_chain.get_id())
-
-        # construct a corresponding rule
-        tp_src_start = tp_src_end = None
-        tp_dst_start = tp_dst_end = None
-        nw_src_address = None
-        nw_src_length = None
-        port_group_id = None
-
-        # handle source
-        if rule['cidr'] != None:
-            nw_src_address, nw_src_length = rule['cidr'].split('/')
-        else:  # security group as a srouce
-            port_groups = self.mido_api.get_port_groups(
-                {'tenant_id': tenant_id})
-            ctxt = context.get_admin_context()
-            if self.virtapi:
-                self.security_group_api.get(id=rule['group_id'])
-            else:
-                group = db.security_group_get(ctxt, rule['group_id'])
-
-            pg_name = port_group_name(group['id'], group['name'])
-            found = False
-            for pg in port_groups:
-                if pg.get_name() == pg_name:
-                    port_group_id = pg.get_id()
-                    found = True
-            assert found
-
-        # dst ports
-        tp_dst_start, tp_dst_end = rule['from_port'], rule['to_port']
-
-        # protocol
-        if rule['protocol'] == 'tcp':
-            nw_proto = 6
-        elif rule['protocol'] == 'udp':
-            nw_proto = 17
-        elif rule['protocol'] == 'icmp':
-            nw_proto = 1
-            # extract type and code from reporposed fields
-            icmp_type = rule['from_port']
-            icmp_code = rule['to_port']
-
-            # translate -1(wildcard in OS) to midonet wildcard
-            if icmp_type == -1:
-                icmp_type = None
-            if icmp_code == -1:
-                icmp_code = None
-
-            # set data for midonet rule
-            tp_src_start = tp_src_end = icmp_type
-            tp_dst_start = tp_dst_end = icmp_code
-        tp_src  = {'start': tp_src_start, 'end': tp_src_end}
-        tp_dst  = {'start': tp_dst_start, 'end': tp_dst_end}
+        sg_chain = self.chain_manager.get_by_name(tenant_id, cname)
+        assert sg_chain
+        LOG.debug('putting rules to the chain id=%r', sg_chain.get_id())
+
+        ctxt = None
+        port_group_ids = {}
+        for rule, fields in zip(rules, compiled):
+            port_group_id = None
+            if rule['cidr'] == None:  # security group as a source
+                group_id = rule['group_id']
+                if group_id not in port_group_ids:
+                    if ctxt is None:
+                        ctxt = context.get_admin_context()
+                    group = self._get_security_group(ctxt, group_id)
+                    pg_name = port_group_name(group['id'], group['name'])
+                    pg = self.pg_manager.get_by_name(tenant_id, pg_name)
+                    assert pg
+                    port_group_ids[group_id] = pg.get_id()
+                port_group_id = port_group_ids[group_id]
+
+            self._add_sg_rule(tenant_id, sg_chain, rule, fields,
+                              port_group_id)
+
+    def _add_sg_rule(self, tenant_id, sg_chain, rule, fields, port_group_id):
+        LOG.debug('parent_group_id=%r, rule_id=%r, fields=%r',
+                  rule['parent_group_id'], rule['id'], fields)
 
         # create an accept rule
         properties = self._properties(rule['id'])
-        chain = self.mido_api.get_chain(sg_chain.get_id())
-        chain.add_rule().port_group(port_group_id)\
-                        .type('accept')\
-                        .nw_proto(nw_proto)\
-                        .nw_src_address(nw_src_address)\
-                        .nw_src_length(nw_src_length)\
-                        .tp_src(tp_src)\
-                        .tp_dst(tp_dst)\
-                        .properties(properties)\
-                        .create()
+        builder = self._rule_builder(
+            sg_chain, fields + (('port_group', port_group_id),
+                                ('properties', properties)))
+        try:
+            mido_rule = builder.create()
+        except w_exc.HTTPNotFound:
+            # the cached chain was deleted elsewhere
+            self.chain_manager.invalidate(tenant_id)
+            raise
+        for rule_id in rule_optimizer.split_ids(rule['id']):
+            self.rule_index.add(rule_id, mido_rule)
 
     def delete_for_sg(self, tenant_id, rule_id):
-        LOG.debug('tenant_id=%r, rule_id=%r', tenant_id, rule_id)
+        self.delete_for_sg_rules(tenant_id, [rule_id])
 
-        properties = self._properties(rule_id)
-        # search for the chains to find the rule to delete
-        chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-        for c in chains:
-            rules = c.get_rules()
-            for r in rules:
-                if r.get_properties() == properties:
-                    LOG.debug('deleting rule=%r', r)
-                    r.delete()
+    def delete_for_sg_rules(self, tenant_id, rule_ids):
+        """Deletes the MidoNet rules created for the Nova rules. A MidoNet
+           rule also standing for other Nova rules is replaced by rules for
+           those.
+        """
+        LOG.debug('tenant_id=%r, rule_ids=%r', tenant_id, rule_ids)
+
+        deleted = set(str(r) for r in rule_ids)
+        mido_rules = {}
+        missing = set()
+        for rule_id in deleted:
+            mido_rule = self.rule_index.pop(rule_id)
+            if mido_rule:
+                mido_rules[mido_rule.get_id()] = mido_rule
+            else:
+                missing.add(rule_id)
+
+        recreated = set()
+
+        def delete(mido_rule):
+            # rules standing in for the others come first so that their
+            # traffic is never dropped meanwhile
+            others = set(nova_rule_ids(mido_rule)) - deleted - recreated
+            if others:
+                self._recreate_sg_rules(tenant_id, others)
+                recreated.update(others)
+            LOG.debug('deleting rule=%r', mido_rule)
+            mido_rule.delete()
+
+        for mido_rule in mido_rules.values():
+            try:
+                delete(mido_rule)
+            except w_exc.HTTPNotFound:
+                # the indexed rule was replaced elsewhere, e.g. by another
+                # worker or the reconciler; look for the live one
+                LOG.debug('indexed rule=%r is gone', mido_rule)
+                missing.update(deleted.intersection(nova_rule_ids(mido_rule)))
+
+        if missing:
+            # not indexed; search for the chains to find the rules to delete
+            chains = self.chain_manager.chain_index.find_prefix(tenant_id,
+                                                                PREFIX)
+            for c in chains:
+                if not is_sg_chain_name(c.get_name()):
+                    continue
+                for r in c.get_rules():
+                    if missing.intersection(nova_rule_ids(r)):
+                        try:
+                            delete(r)
+                        except w_exc.HTTPNotFound:
+                            LOG.debug('rule=%r is already gone', r)
+
+    def _recreate_sg_rules(self, tenant_id, rule_ids):
+        """Creates the MidoNet rules of Nova rules again, before the merged
+           rule that stood for them is deleted.
+        """
+        LOG.debug('tenant_id=%r, rule_ids=%r', tenant_id, rule_ids)
+        ctxt = context.get_admin_context()
+        by_group = collections.OrderedDict()
+        for rule_id in sorted(rule_ids):
+            self.rule_index.pop(rule_id)
+            try:
+                rule = db.security_group_rule_get(ctxt, rule_id)
+            except exception.NotFound:
+                # deleted meanwhile; its own deletion has nothing left to do
+                continue
+            by_group.setdefault(rule['parent_group_id'], []).append(rule)
+
+        for sg_id, rules in by_group.items():
+            group = self._get_security_group(ctxt, sg_id)
+            self.create_for_sg_rules(tenant_id, sg_id, group['name'], rules)
+
+    @contextlib.contextmanager
+    def snapshot(self, tenant_ids):
+        """Fetches the chains and port groups of the tenants unless cached,
+           and keeps using these listings until the block exits.
+        """
+        indexes = (self.chain_manager.chain_index, self.pg_manager.pg_index)
+        held = []
+        try:
+            for tenant_id in tenant_ids:
+                for index in indexes:
+                    index.hold(tenant_id)
+                    held.append((index, tenant_id))
+                    index.load(tenant_id)
+            yield
+        finally:
+            for index, tenant_id in held:
+                index.release(tenant_id)
+
+    def warm_up(self, tenant_ids, concurrency=None):
+        """Fetches the chains and port groups of the tenants unless cached,
+           with at most concurrency tenants at a time. Returns the number of
+           tenants whose listings could not be fetched.
+        """
+        LOG.debug('tenant_ids=%r', tenant_ids)
+        if concurrency is None:
+            concurrency = CONF.MIDONET.warm_up_concurrency
+
+        def load(tenant_id):
+            self.chain_manager.chain_index.load(tenant_id)
+            self.pg_manager.pg_index.load(tenant_id)
+
+        results = run_concurrently(
+            [functools.partial(load, t) for t in tenant_ids], concurrency,
+            return_exceptions=True)
+        failed = 0
+        for tenant_id, result in zip(tenant_ids, results):
+            if isinstance(result, Exception):
+                LOG.warn('Failed to fetch resources of tenant_id=%r: %r',
+                         tenant_id, result)
+                failed += 1
+        return failed
+
+    def get_security_groups(self, ctxt, instance):
+        if self.virtapi:
+            return self.virtapi.security_group_get_by_instance(ctxt,
+                                                               instance)
+        else:
+            return db.security_group_get_by_instance(ctxt, instance['id'])
 
     def create_for_vif(self, tenant_id, instance, network, vif_chains,
-            allow_same_net_traffic):
+            allow_same_net_traffic, security_groups=None):
+        """Sets up the rules of the VIF chains and the VIF's port.
+
+           security_groups of the instance may be given by a caller that has
+           already looked them up.
+        """
         LOG.debug('tenant_id=%r, instance=%r, network=%r, vif_chains=%r',
                   tenant_id, instance['id'], network, vif_chains)
 
@@ -300,139 +1023,242 @@ class RuleManager:
         mac = network[1]['mac']
         ip = network[1]['ips'][0]['ip']
 
+        in_chain = vif_chains['in']
+        out_chain = vif_chains['out']
+
         #
         # ingress
         #
 
-        position = 1
-        in_chain = vif_chains['in']
-        out_chain = vif_chains['out']
-        # mac spoofing protection
-        in_chain.add_rule().type('drop')\
-                           .dl_src(mac)\
-                           .inv_dl_src(True)\
-                           .position(position)\
-                           .create()
-        position += 1
-
-        # ip spoofing protection
-        in_chain.add_rule().type('drop')\
-                           .nw_src_address(ip)\
-                           .nw_src_length(32)\
-                           .inv_nw_src(True)\
-                           .dl_type(0x0800)\
-                           .position(position)\
-                           .create()
-        position += 1
-
-        # conntrack
-        in_chain.add_rule().type('accept')\
-                           .match_forward_flow(True)\
-                           .position(position)\
-                           .create()
-        position += 1
+        in_rules = [
+            # mac spoofing protection
+            [('type', 'drop'), ('dl_src', mac), ('inv_dl_src', True)],
+            # ip spoofing protection
+            [('type', 'drop'), ('nw_src_address', ip), ('nw_src_length', 32),
+             ('inv_nw_src', True), ('dl_type', 0x0800)],
+            # conntrack
+            [('type', 'accept'), ('match_forward_flow', True)],
+        ]
 
         #
         # egress
         #
 
         ctxt = context.get_admin_context()
-        if self.virtapi:
-            security_groups = self.virtapi.security_group_get_by_instance(
-                ctxt, instance)
-        else:
-            security_groups = db.security_group_get_by_instance(ctxt,
-                                                                instance['id'])
-
-        position = 1
-        # get the port groups to match for the rule
-        port_groups = self.mido_api.get_port_groups({'tenant_id': tenant_id})
-
-        if allow_same_net_traffic:
-            LOG.debug('accept cidr=%r', net_cidr)
-            nw_src_address, nw_src_length = net_cidr.split('/')
-            out_chain.add_rule().type('accept')\
-                                .nw_src_address(nw_src_address)\
-                                .nw_src_length(nw_src_length)\
-                                .position(position)\
-                                .create()
-            position += 1
+        if security_groups is None:
+            security_groups = self.get_security_groups(ctxt, instance)
+
+        out_rules = []
+        # the port groups the vif should belong to
+        port_groups = []
+
+        shared_out_chain = None
+        if CONF.MIDONET.shared_vif_chains:
+            shared_out_chain = self._get_shared_out_chain(
+                tenant_id, bridge_uuid, net_cidr, allow_same_net_traffic)
+        elif allow_same_net_traffic:
+            out_rules.extend(self._same_net_rules(net_cidr))
 
         # add rules that correspond to Nova SG
         for sg in security_groups:
             LOG.debug('security group=%r', sg['name'])
-            if self.virtapi:
-                rules = self.virtapi.security_group_rule_get_by_security_group(
-                    ctxt, sg)
-            else:
-                rules = db.security_group_rule_get_by_security_group(
-                    ctxt, sg['id'])
-
             LOG.debug('sg_id=%r', sg['id'])
             LOG.debug('sg_project_id=%r', sg['project_id'])
             LOG.debug('name=%r', sg['name'])
-            LOG.debug('rules=%r', rules)
 
             cname = chain_name(sg['id'], sg['name'])
-            chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-            jump_chain_id = None
-            for c in chains:
-                if c.get_name() == cname:
-                    jump_chain_id = c.get_id()
-                    break
-
-            # sg handler must have missed the event of creating the SG.
-            # Now doing the equivalent as a quick workaround.
-            if not jump_chain_id:
-                def create_sg_resources(tenant_id, sg_id, sg_name):
-                    self.chain_manager.create_for_sg(tenant_id, sg_id, sg_name)
-                    self.pg_manager.create(tenant_id, sg_id, sg_name)
-                create_sg_resources(tenant_id, sg['id'], sg['name'])
-
-                chains = self.mido_api.get_chains({'tenant_id': tenant_id})
-                jump_chain_id = None
-                for c in chains:
-                    if c.get_name() == cname:
-                        jump_chain_id = c.get_id()
-                        break
-                assert jump_chain_id
-
-            rule = out_chain.add_rule().type('jump')\
-                                       .position(position)\
-                                       .jump_chain_id(jump_chain_id)\
-                                       .jump_chain_name(cname)\
-                                       .create()
-            position += 1
+            jump_chain = self._get_sg_chain(tenant_id, sg)
+            out_rules.append(self._jump_rule(jump_chain))
 
             # Look for the port group that the vif should belong to
-            for pg in port_groups:
-                if pg.get_name() != cname:
-                    port_groups.remove(pg)
+            pg = self.pg_manager.get_by_name(tenant_id, cname)
+            if pg:
+                port_groups.append(pg)
 
-        # add reverse flow matching at the end
-        out_chain.add_rule().type('accept')\
-                            .match_return_flow(True)\
-                            .position(position)\
-                            .create()
-        position += 1
-
-        # fall back DROP rule at the end except for ARP
-        out_chain.add_rule().type('drop')\
-                            .dl_type(0x0806)\
-                            .inv_dl_type(True)\
-                            .position(position)\
-                            .create()
+        if shared_out_chain:
+            out_rules.append(self._jump_rule(shared_out_chain))
+        else:
+            out_rules.extend(self._fallback_rules())
+
+        # The rules of a chain are created in order, so their positions are
+        # the same as in sequential mode; the chains and the port lookup
+        # are handled concurrently.
+        concurrency = CONF.MIDONET.vif_rule_concurrency
+        created = []
+        failed = []
+
+        def get_port():
+            self.mido_api.get_bridge(bridge_uuid)
+            return self.mido_api.get_port(vif_uuid)
+
+        try:
+            results = run_concurrently(
+                [lambda: self._create_rules(in_chain, in_rules, created,
+                                            failed),
+                 lambda: self._create_rules(out_chain, out_rules, created,
+                                            failed),
+                 get_port],
+                concurrency)
+
+            #
+            # Updating the vport
+            #
+            bridge_port = results[2]
+            LOG.debug('bridge_port=%r found', bridge_port)
+
+            # set filters
+            bridge_port.inbound_filter_id(in_chain.get_id())
+            bridge_port.outbound_filter_id(out_chain.get_id())
+            bridge_port.update()
+            port_id = bridge_port.get_id()
+            run_concurrently(
+                [lambda pg=pg: created.append(
+                    pg.add_port_group_port().port_id(port_id).create())
+                 for pg in port_groups],
+                concurrency)
+        except Exception:
+            LOG.exception('Failed to set up rules for vif=%r, cleaning up',
+                          vif_uuid)
+            for r in created:
+                try:
+                    r.delete()
+                except Exception:
+                    LOG.warn('Failed to clean up %r', r)
+            raise
+
+    def _get_sg_chain(self, tenant_id, sg):
+        cname = chain_name(sg['id'], sg['name'])
+        jump_chain = self.chain_manager.get_by_name(tenant_id, cname)
+
+        # sg handler must have missed the event of creating the SG.
+        # Now doing the equivalent as a quick workaround.
+        if not jump_chain:
+            def create_sg_resources(tenant_id, sg_id, sg_name):
+                self.chain_manager.create_for_sg(tenant_id, sg_id, sg_name)
+                if not self.pg_manager.get_by_name(tenant_id, cname):
+                    self.pg_manager.create(tenant_id, sg_id, sg_name)
+            create_sg_resources(tenant_id, sg['id'], sg['name'])
 
-        #
-        # Updating the vport
-        #
-        bridge = self.mido_api.get_bridge(bridge_uuid)
-        bridge_port = self.mido_api.get_port(vif_uuid)
-        LOG.debug('bridge_port=%r found', bridge_port)
-
-        # set filters
-        bridge_port.inbound_filter_id(in_chain.get_id())
-        bridge_port.outbound_filter_id(out_chain.get_id())
-        bridge_port.update()
-        for pg in port_groups:
-            pg.add_port_group_port().port_id(bridge_port.get_id()).create()
+            jump_chain = self.chain_manager.get_by_name(tenant_id, cname)
+            assert jump_chain
+        return jump_chain
+
+    def _jump_rule(self, chain):
+        return [('type', 'jump'),
+                ('jump_chain_id', chain.get_id()),
+                ('jump_chain_name', chain.get_name())]
+
+    def sync_vif_security_groups(self, tenant_id, vif_uuid, security_groups):
+        """Brings the security group jump rules in the VIF's out chain and the
+           port group memberships of its port in line with security_groups,
+           creating and deleting only what differs.
+        """
+        LOG.debug('tenant_id=%r, vif_uuid=%r, security_groups=%r', tenant_id,
+                  vif_uuid, [sg['name'] for sg in security_groups])
+
+        out_chain = self.chain_manager.get_for_vif(tenant_id, vif_uuid, 'out')
+        if not out_chain:
+            LOG.info('No chain for vif=%r; nothing to refresh', vif_uuid)
+            return
+
+        desired = {}
+        for sg in security_groups:
+            desired[chain_name(sg['id'], sg['name'])] = sg
+
+        current = {}
+        for r in out_chain.get_rules():
+            if r.get_type() == 'jump' and \
+                    is_sg_chain_name(r.get_jump_chain_name() or ''):
+                current[r.get_jump_chain_name()] = r
+
+        # Rules before the final drop only accept or jump to accepting
+        # chains, so a new jump can go to the top of the chain.
+        for cname, sg in desired.items():
+            if cname in current:
+                continue
+            jump_chain = self._get_sg_chain(tenant_id, sg)
+            LOG.debug('adding jump to chain=%r', cname)
+            self._create_rules(out_chain, [self._jump_rule(jump_chain)], [],
+                               [])
+            pg = self.pg_manager.get_by_name(tenant_id, cname)
+            if pg:
+                pg.add_port_group_port().port_id(vif_uuid).create()
+
+        for cname, rule in current.items():
+            if cname in desired:
+                continue
+            LOG.debug('removing jump to chain=%r', cname)
+            rule.delete()
+            pg = self.pg_manager.get_by_name(tenant_id, cname)
+            if pg:
+                for pg_port in pg.get_ports():
+                    if pg_port.get_port_id() == vif_uuid:
+                        pg_port.delete()
+
+    def _same_net_rules(self, net_cidr):
+        LOG.debug('accept cidr=%r', net_cidr)
+        nw_src_address, nw_src_length = net_cidr.split('/')
+        return [[('type', 'accept'),
+                 ('nw_src_address', nw_src_address),
+                 ('nw_src_length', nw_src_length)]]
+
+    def _fallback_rules(self):
+        # add reverse flow matching at the end
+        return [[('type', 'accept'), ('match_return_flow', True)],
+                # fall back DROP rule at the end except for ARP
+                [('type', 'drop'), ('dl_type', 0x0806),
+                 ('inv_dl_type', True)]]
+
+    def _get_shared_out_chain(self, tenant_id, network_id, net_cidr,
+                              allow_same_net_traffic):
+        """Returns the egress chain shared by the VIFs of the network, creating
+           it with the rules that do not depend on the VIF if not found.
+
+           Accept rules commute, so moving the same network and return flow
+           rules after the security group jumps does not change the verdict.
+        """
+        with self._shared_chain_lock:
+            chain = self.chain_manager.get_for_network(tenant_id, network_id,
+                                                       'out')
+            if chain:
+                return chain
+
+            chain = self.chain_manager.create_for_network(tenant_id,
+                                                          network_id, 'out')
+            rules = []
+            if allow_same_net_traffic:
+                rules.extend(self._same_net_rules(net_cidr))
+            rules.extend(self._fallback_rules())
+            try:
+                self._create_rules(chain, rules, [], [])
+            except Exception:
+                # do not leave a chain without the fall back rule around
+                self.chain_manager.delete_for_network(tenant_id, network_id,
+                                                      'out')
+                raise
+            # the lock does not cover other hosts
+            return self.chain_manager.keep_one(tenant_id, chain)
+
+    def _create_rules(self, chain, rules, created, failed):
+        """Creates the rules in the chain, at positions in list order. Each
+           rule is a list of (setter, value) of the rule builder. Stops early
+           once failed is set by another task.
+        """
+        for position, fields in enumerate(rules, 1):
+            if failed:
+                return
+            builder = self._rule_builder(chain, fields)
+            try:
+                created.append(builder.position(position).create())
+            except Exception:
+                failed.append(chain)
+                raise
+
+    def _rule_builder(self, chain, fields):
+        """Returns a rule builder of the chain with the (setter, value) fields
+           set.
+        """
+        builder = chain.add_rule()
+        for setter, value in fields:
+            builder = getattr(builder, setter)(value)
+        return builder
@@ -0,0 +1,297 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Brings the security group chains, port groups and rules of tenants in
+MidoNet back in line with Nova's database.
+
+The desired state is computed from the security groups of a tenant, the
+actual state from one listing of the tenant's chains and port groups plus
+the rules of its security group chains, and only the differences are
+applied.
+
+    python -m midonet.nova.network.reconciler --dry-run TENANT_ID ... \\
+        -- --config-file /etc/nova/nova.conf
+"""
+
+import argparse
+import collections
+import functools
+import sys
+
+from webob import exc as w_exc
+
+from oslo.config import cfg
+
+from nova import context
+from nova import db
+from nova.openstack.common import log as logging
+
+from midonet.nova import midonet_connection
+from midonet.nova.network import midonet_lib
+
+
+LOG = logging.getLogger('nova...' + __name__)
+
+reconciler_opts = [
+    cfg.IntOpt('reconcile_concurrency',
+               default=4,
+               help=('Maximum number of concurrent MidoNet API requests '
+                     'made by the security group reconciler.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(reconciler_opts, 'MIDONET')
+
+
+class Plan:
+    """The changes that bring a tenant's MidoNet resources to the state
+    described by Nova. Nova rules never change once created, so rules are
+    compared by their os_sg_rule_id property only.
+    """
+
+    def __init__(self, tenant_id):
+        self.tenant_id = tenant_id
+        # security groups whose chain or port group is missing
+        self.create_chains = []
+        self.create_port_groups = []
+        # chain name -> (security group, [Nova rules])
+        self.create_rules = collections.OrderedDict()
+        # MidoNet resources to delete
+        self.delete_rules = []
+        self.delete_chains = []
+        self.delete_port_groups = []
+
+    def __len__(self):
+        return (len(self.create_chains) + len(self.create_port_groups) +
+                sum(len(rules) for sg, rules in self.create_rules.values()) +
+                len(self.delete_rules) + len(self.delete_chains) +
+                len(self.delete_port_groups))
+
+    def describe(self):
+        """Returns the plan as lines of text."""
+        lines = []
+        for sg in self.create_chains:
+            lines.append('create chain %s' % midonet_lib.chain_name(
+                sg['id'], sg['name']))
+        for sg in self.create_port_groups:
+            lines.append('create port group %s' % midonet_lib.port_group_name(
+                sg['id'], sg['name']))
+        for cname, (sg, rules) in self.create_rules.items():
+            for rule in rules:
+                lines.append('create rule %s in chain %s' % (rule['id'],
+                                                             cname))
+        for r in self.delete_rules:
+            lines.append('delete rule %s (%s) in chain %s' % (
+                r.get_id(), _rule_id(r), r.get_chain_id()))
+        for c in self.delete_chains:
+            lines.append('delete chain %s' % c.get_name())
+        for pg in self.delete_port_groups:
+            lines.append('delete port group %s' % pg.get_name())
+        return ['tenant %s: %s' % (self.tenant_id, l) for l in lines]
+
+
+def _rule_id(mido_rule):
+    return (mido_rule.get_properties() or {}).get(
+        midonet_lib.RuleManager.OS_SG_KEY)
+
+
+class Reconciler:
+
+    def __init__(self, mido_api, concurrency=None):
+        self.mido_api = mido_api
+        if concurrency is None:
+            concurrency = CONF.MIDONET.reconcile_concurrency
+        self.concurrency = concurrency
+        self.chain_manager = midonet_lib.ChainManager(mido_api)
+        self.pg_manager = midonet_lib.PortGroupManager(mido_api)
+        self.rule_manager = midonet_lib.RuleManager(
+            mido_api, chain_manager=self.chain_manager,
+            pg_manager=self.pg_manager)
+
+    def _desired(self, ctxt, tenant_id):
+        """Returns the security groups of the tenant keyed by chain name,
+           with their rules loaded along in one query.
+        """
+        desired = collections.OrderedDict()
+        for sg in db.security_group_get_by_project(ctxt, tenant_id):
+            desired[midonet_lib.chain_name(sg['id'], sg['name'])] = sg
+        return desired
+
+    def _actual(self, tenant_id):
+        """Fetches the security group chains and port groups of the tenant,
+           keyed by name.
+        """
+        self.chain_manager.chain_index.refresh(tenant_id)
+        self.pg_manager.pg_index.refresh(tenant_id)
+        chains = dict((c.get_name(), c) for c in
+                      self.chain_manager.chain_index.find_prefix(
+                          tenant_id, midonet_lib.PREFIX,
+                          refresh_on_miss=False)
+                      if midonet_lib.is_sg_chain_name(c.get_name()))
+        port_groups = dict((pg.get_name(), pg) for pg in
+                           self.pg_manager.pg_index.find_prefix(
+                               tenant_id, midonet_lib.PREFIX,
+                               refresh_on_miss=False))
+        return chains, port_groups
+
+    def _get_rules(self, chains):
+        """Fetches the rules of the chains, keyed by chain name."""
+        names = list(chains)
+        rules = midonet_lib.run_concurrently(
+            [chains[n].get_rules for n in names], self.concurrency)
+        return dict(zip(names, rules))
+
+    def plan(self, ctxt, tenant_id):
+        """Computes the changes to apply for the tenant."""
+        LOG.debug('tenant_id=%r', tenant_id)
+        plan = Plan(tenant_id)
+        desired = self._desired(ctxt, tenant_id)
+        chains, port_groups = self._actual(tenant_id)
+        # rules of chains about to be deleted need not be fetched
+        chain_rules = self._get_rules(
+            dict((n, c) for n, c in chains.items() if n in desired))
+
+        for cname, sg in desired.items():
+            if cname not in chains:
+                plan.create_chains.append(sg)
+            if cname not in port_groups:
+                plan.create_port_groups.append(sg)
+
+            wanted = dict((str(r['id']), r) for r in sg['rules'])
+            seen = set()
+            for r in chain_rules.get(cname, []):
+                rule_ids = set(midonet_lib.nova_rule_ids(r))
+                if (rule_ids and rule_ids.issubset(wanted) and
+                        not rule_ids.intersection(seen)):
+                    seen.update(rule_ids)
+                else:
+                    # unknown to Nova, standing for a deleted rule or
+                    # duplicated; the rules still wanted are created again
+                    plan.delete_rules.append(r)
+            missing = [r for r in sg['rules'] if str(r['id']) not in seen]
+            if missing:
+                plan.create_rules[cname] = (sg, missing)
+
+        for cname, c in chains.items():
+            if cname not in desired:
+                # its rules are deleted along with it
+                plan.delete_chains.append(c)
+        for pg_name, pg in port_groups.items():
+            if pg_name not in desired:
+                plan.delete_port_groups.append(pg)
+        return plan
+
+    def apply(self, plan):
+        """Applies the plan, creating before deleting so that rules sourced
+           from a new port group can refer to it. Returns the list of the
+           errors met; the remaining changes are still attempted.
+        """
+        tenant_id = plan.tenant_id
+        LOG.info('tenant_id=%r: applying %d changes', tenant_id, len(plan))
+        errors = []
+
+        def run(tasks):
+            for result in midonet_lib.run_concurrently(
+                    tasks, self.concurrency, return_exceptions=True):
+                if isinstance(result, Exception):
+                    LOG.warn('tenant_id=%r: reconciling failed: %r',
+                             tenant_id, result)
+                    errors.append(result)
+
+        run([functools.partial(self.chain_manager.create_for_sg, tenant_id,
+                               sg['id'], sg['name'])
+             for sg in plan.create_chains] +
+            [functools.partial(self.pg_manager.create, tenant_id, sg['id'],
+                               sg['name'])
+             for sg in plan.create_port_groups])
+
+        # the rules of a chain are created in order, chains concurrently
+        run([functools.partial(self.rule_manager.create_for_sg_rules,
+                               tenant_id, sg['id'], sg['name'], rules)
+             for sg, rules in plan.create_rules.values()])
+
+        def delete(resource):
+            try:
+                resource.delete()
+            except w_exc.HTTPNotFound:
+                LOG.debug('%r is already gone', resource)
+
+        run([functools.partial(delete, r) for r in plan.delete_rules])
+        run([functools.partial(delete, c) for c in plan.delete_chains] +
+            [functools.partial(delete, pg) for pg in plan.delete_port_groups])
+        for c in plan.delete_chains:
+            self.rule_manager.rule_index.remove_chain(c.get_id())
+
+        self.chain_manager.invalidate(tenant_id)
+        self.pg_manager.invalidate(tenant_id)
+        return errors
+
+    def reconcile(self, ctxt, tenant_id, dry_run=False):
+        """Plans and, unless dry_run, applies the changes for the tenant.
+           Returns the plan and the errors met.
+        """
+        plan = self.plan(ctxt, tenant_id)
+        if dry_run or not len(plan):
+            return plan, []
+        return plan, self.apply(plan)
+
+
+def _all_tenants(ctxt):
+    return sorted(set(sg['project_id']
+                      for sg in db.security_group_get_all(ctxt)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Reconcile MidoNet security group resources with the '
+                     'Nova database.'))
+    parser.add_argument('tenants', nargs='*', help='tenant ids')
+    parser.add_argument('--all-tenants', action='store_true',
+                        help='reconcile every tenant having security groups')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the changes without applying them')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='concurrent MidoNet API requests')
+    argv = sys.argv[1:]
+    conf_argv = []
+    if '--' in argv:
+        conf_argv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    if not args.tenants and not args.all_tenants:
+        parser.error('give tenant ids or --all-tenants')
+    CONF(conf_argv, project='nova')
+    logging.setup('nova')
+
+    ctxt = context.get_admin_context()
+    reconciler = Reconciler(midonet_connection.get_mido_api(),
+                            args.concurrency)
+    tenants = args.tenants or _all_tenants(ctxt)
+
+    failed = False
+    for tenant_id in tenants:
+        plan, errors = reconciler.reconcile(ctxt, tenant_id, args.dry_run)
+        for line in plan.describe():
+            print(line)
+        for e in errors:
+            print('tenant %s: error: %s' % (tenant_id, e))
+        failed = failed or bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
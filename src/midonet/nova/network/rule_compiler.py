@@ -0,0 +1,116 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Translates Nova security group rules into MidoNet rule fields.
+
+A compiled rule is a tuple of (setter, value) pairs of the MidoNet rule
+builder, without the port group and the properties which depend on the
+rule's identity. Rules of the same shape, i.e. protocol, ports and CIDR,
+compile to the same tuple, which is computed once.
+"""
+
+import threading
+
+# protocol names accepted by Nova and their IP protocol numbers
+PROTOCOLS = {
+    'icmp': 1,
+    'tcp': 6,
+    'udp': 17,
+}
+
+ICMP = PROTOCOLS['icmp']
+
+# protocols whose from_port and to_port are a range of destination ports
+PORT_PROTOCOLS = (PROTOCOLS['tcp'], PROTOCOLS['udp'])
+
+# Nova's wildcard for ICMP type and code
+ICMP_ANY = -1
+
+_MAX_CACHED = 4096
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def protocol_number(protocol):
+    """Returns the IP protocol number of a Nova rule protocol, given by name
+       or number, or None if the rule matches any protocol.
+    """
+    if protocol is None or protocol == '':
+        return None
+    name = str(protocol).lower()
+    if name in PROTOCOLS:
+        return PROTOCOLS[name]
+    try:
+        number = int(name)
+    except ValueError:
+        raise ValueError('Unsupported protocol %r' % (protocol,))
+    if number < 0 or number > 255:
+        raise ValueError('Invalid protocol number %r' % (protocol,))
+    return number
+
+
+def _compile(protocol, from_port, to_port, cidr):
+    nw_proto = protocol_number(protocol)
+
+    nw_src_address = nw_src_length = None
+    if cidr is not None:
+        nw_src_address, nw_src_length = cidr.split('/')
+
+    tp_src_start = tp_src_end = None
+    tp_dst_start = tp_dst_end = None
+    if nw_proto == ICMP:
+        # the ICMP type and code are carried in the port fields
+        icmp_type = None if from_port == ICMP_ANY else from_port
+        icmp_code = None if to_port == ICMP_ANY else to_port
+        tp_src_start = tp_src_end = icmp_type
+        tp_dst_start = tp_dst_end = icmp_code
+    elif nw_proto in PORT_PROTOCOLS:
+        tp_dst_start, tp_dst_end = from_port, to_port
+
+    return (('type', 'accept'),
+            ('nw_proto', nw_proto),
+            ('nw_src_address', nw_src_address),
+            ('nw_src_length', nw_src_length),
+            ('tp_src', {'start': tp_src_start, 'end': tp_src_end}),
+            ('tp_dst', {'start': tp_dst_start, 'end': tp_dst_end}))
+
+
+def compile_rule(rule):
+    """Returns the MidoNet fields of a Nova rule. The result is shared by
+       rules of the same shape and must not be modified.
+    """
+    shape = (rule['protocol'], rule['from_port'], rule['to_port'],
+             rule['cidr'])
+    fields = _cache.get(shape)
+    if fields is None:
+        fields = _compile(*shape)
+        with _cache_lock:
+            if len(_cache) >= _MAX_CACHED:
+                _cache.clear()
+            _cache[shape] = fields
+    return fields
+
+
+def compile_rules(rules):
+    """Returns the MidoNet fields of each of the Nova rules, in order."""
+    return [compile_rule(r) for r in rules]
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,244 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reduces the Nova rules of a security group to fewer equivalent rules.
+
+All the rules of a security group chain accept, so their order does not
+matter and any set of rules matching the same packets will do:
+
+ * tcp and udp rules with the same source and overlapping or adjacent port
+   ranges are collapsed into one range,
+ * rules with the same protocol and ports from adjacent or nested CIDRs are
+   merged into the covering CIDRs,
+ * rules matching a subset of what another rule matches are dropped.
+
+Each resulting rule carries the ids of the Nova rules it stands for, joined
+with commas in its id, so that a MidoNet rule can be traced back to them.
+"""
+
+import collections
+
+import netaddr
+
+from midonet.nova.network import rule_compiler
+
+ID_SEPARATOR = ','
+
+ANY_PORT = (0, 65535)
+
+_BITS = {4: 32, 6: 128}
+
+
+def join_ids(rule_ids):
+    return ID_SEPARATOR.join(str(r) for r in rule_ids)
+
+
+def split_ids(joined):
+    """Returns the Nova rule ids a MidoNet rule's os_sg_rule_id stands for."""
+    if not joined:
+        return []
+    return str(joined).split(ID_SEPARATOR)
+
+
+class _Rule:
+
+    def __init__(self, template, proto, source, ports, ids):
+        self.template = template
+        self.proto = proto
+        # ('cidr', IPNetwork) or ('group', group id)
+        self.source = source
+        self.ports = ports
+        self.ids = ids
+
+    def covers(self, other):
+        """Tells if this rule matches every packet the other one matches."""
+        if self.proto is not None and self.proto != other.proto:
+            return False
+        if not _source_covers(self.source, other.source):
+            return False
+        if self.proto is None:
+            return True
+        if self.proto in rule_compiler.PORT_PROTOCOLS:
+            return (self.ports[0] <= other.ports[0] and
+                    other.ports[1] <= self.ports[1])
+        if self.proto == rule_compiler.ICMP:
+            return all(mine in (rule_compiler.ICMP_ANY, theirs)
+                       for mine, theirs in zip(self.ports, other.ports))
+        return True
+
+    def to_nova(self):
+        rule = dict(self.template)
+        rule['id'] = join_ids(self.ids)
+        if self.source[0] == 'cidr':
+            rule['cidr'] = str(self.source[1])
+            rule['group_id'] = None
+        else:
+            rule['cidr'] = None
+            rule['group_id'] = self.source[1]
+        rule['from_port'], rule['to_port'] = self.ports
+        return rule
+
+
+def _source_covers(mine, theirs):
+    if mine[0] != theirs[0]:
+        return False
+    if mine[0] == 'group':
+        return mine[1] == theirs[1]
+    return (mine[1].version == theirs[1].version and
+            theirs[1] in mine[1])
+
+
+def _source_key(source):
+    if source[0] == 'group':
+        return source
+    net = source[1]
+    return ('cidr', net.version, net.value, net.prefixlen)
+
+
+def _normalize(rule):
+    proto = rule_compiler.protocol_number(rule['protocol'])
+    if rule['cidr'] is not None:
+        source = ('cidr', netaddr.IPNetwork(rule['cidr']).cidr)
+    else:
+        source = ('group', rule['group_id'])
+    if proto in rule_compiler.PORT_PROTOCOLS:
+        ports = (rule['from_port'], rule['to_port'])
+        if ports[0] is None or ports[1] is None:
+            ports = ANY_PORT
+    elif proto == rule_compiler.ICMP:
+        ports = (rule['from_port'], rule['to_port'])
+    else:
+        # ports are not matched
+        ports = (None, None)
+    template = {'parent_group_id': rule['parent_group_id'],
+                'protocol': rule['protocol']}
+    return _Rule(template, proto, source, ports, [rule['id']])
+
+
+def _collapse_ports(rules):
+    """Merges the overlapping or adjacent port ranges of tcp and udp rules
+       with the same source.
+    """
+    groups = collections.OrderedDict()
+    others = []
+    for r in rules:
+        if r.proto in rule_compiler.PORT_PROTOCOLS:
+            groups.setdefault((r.proto, r.source), []).append(r)
+        else:
+            others.append(r)
+
+    result = []
+    for group in groups.values():
+        group.sort(key=lambda r: r.ports)
+        current = group[0]
+        for r in group[1:]:
+            if r.ports[0] <= current.ports[1] + 1:
+                current = _Rule(current.template, current.proto,
+                                current.source,
+                                (current.ports[0],
+                                 max(current.ports[1], r.ports[1])),
+                                current.ids + r.ids)
+            else:
+                result.append(current)
+                current = r
+        result.append(current)
+    return result + others
+
+
+def _merge_cidrs(rules):
+    """Replaces rules with the same protocol and ports whose CIDRs are
+       adjacent or nested by rules of the covering CIDRs.
+    """
+    groups = collections.OrderedDict()
+    others = []
+    for r in rules:
+        if r.source[0] == 'cidr':
+            groups.setdefault((r.proto, r.ports), []).append(r)
+        else:
+            others.append(r)
+
+    result = []
+    for group in groups.values():
+        if len(group) == 1:
+            result.extend(group)
+            continue
+        for net in netaddr.cidr_merge([r.source[1] for r in group]):
+            covered = [r for r in group
+                       if r.source[1].version == net.version and
+                       r.source[1] in net]
+            ids = []
+            for r in covered:
+                ids.extend(r.ids)
+            result.append(_Rule(covered[0].template, covered[0].proto,
+                                ('cidr', net), covered[0].ports, ids))
+    return result + others
+
+
+def _drop_shadowed(rules):
+    """Folds the rules matching a subset of what another rule matches into
+       that rule.
+    """
+    # look for covering rules among those whose source may contain the
+    # rule's source rather than among all rules
+    by_source = collections.defaultdict(list)
+    lengths = collections.defaultdict(set)
+    for r in rules:
+        by_source[_source_key(r.source)].append(r)
+        if r.source[0] == 'cidr':
+            lengths[r.source[1].version].add(r.source[1].prefixlen)
+
+    def candidates(r):
+        if r.source[0] == 'group':
+            return by_source[_source_key(r.source)]
+        found = []
+        net = r.source[1]
+        bits = _BITS[net.version]
+        for length in lengths[net.version]:
+            if length > net.prefixlen:
+                continue
+            mask = ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+            found.extend(by_source.get(
+                ('cidr', net.version, net.value & mask, length), []))
+        return found
+
+    dropped = set()
+    for r in rules:
+        for other in candidates(r):
+            if other is r or id(other) in dropped:
+                continue
+            if other.covers(r):
+                other.ids.extend(r.ids)
+                dropped.add(id(r))
+                break
+    return [r for r in rules if id(r) not in dropped]
+
+
+def optimize(rules):
+    """Returns Nova rule dictionaries matching the same packets as the given
+       rules of one security group, usually fewer. The id of each is the
+       joined ids of the rules it stands for.
+    """
+    reduced = [_normalize(r) for r in rules]
+    # merging CIDRs may make port ranges of the same source adjacent, and
+    # collapsing ports may give rules the same ports; repeat while it helps
+    while True:
+        count = len(reduced)
+        reduced = _merge_cidrs(_collapse_ports(reduced))
+        if len(reduced) == count:
+            break
+    reduced = _drop_shadowed(reduced)
+    return [r.to_nova() for r in reduced]
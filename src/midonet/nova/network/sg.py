@@ -15,23 +15,38 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+
 from oslo.config import cfg
 
 from nova import context
 from nova import db
+from nova.network import model as network_model
 from nova.network import sg
 from nova.virt import firewall
 from nova.openstack.common import log as logging
 
 
+from midonet.nova import api_stats
 from midonet.nova import midonet_connection
 from midonet.nova.network import midonet_lib
+from midonet.nova.network import sg_queue
 
 
 LOG = logging.getLogger('nova...' + __name__)
 CONF = cfg.CONF
 
 
+def vif_uuids(instance):
+    """Returns the uuids of the VIFs of the instance from its info cache."""
+    try:
+        network_info = instance['info_cache']['network_info']
+    except (KeyError, TypeError):
+        return []
+    return [vif['id'] for vif in
+            network_model.NetworkInfo.hydrate(network_info or [])]
+
+
 class MidonetFirewallDriver(firewall.FirewallDriver):
     """Firewall driver to setup security group in MidoNet.
        This is called from nova-compute. Since we don't really
@@ -40,10 +55,22 @@ class MidonetFirewallDriver(firewall.FirewallDriver):
 
     def __init__(self, virtapi, **kwarg):
         LOG.debug('virtapi=%r, kwarg=%r', virtapi, kwarg)
-        self.mido_conn = midonet_connection.get_mido_api()
+        self.mido_conn = midonet_connection.LazyMidonetApi()
         self.chain_manager = midonet_lib.ChainManager(self.mido_conn)
-        self.rule_manager = midonet_lib.RuleManager(self.mido_conn, virtapi)
-
+        self.rule_manager = midonet_lib.RuleManager(
+            self.mido_conn, virtapi, chain_manager=self.chain_manager)
+        if CONF.MIDONET.warm_up_caches:
+            midonet_lib.warm_up_in_background('firewall', self.warm_up)
+
+    def warm_up(self, tenant_ids=None):
+        """Fetches the chains and port groups of the tenants, by default
+           those having instances on this host.
+        """
+        if tenant_ids is None:
+            tenant_ids = midonet_lib.tenants_on_host()
+        self.rule_manager.warm_up(tenant_ids)
+
+    @api_stats.tagged
     def prepare_instance_filter(self, instance, network_info):
         LOG.debug('instance=%r, network_info=%r', instance, network_info)
 
@@ -51,10 +78,16 @@ class MidonetFirewallDriver(firewall.FirewallDriver):
             LOG.info('Do nothing as there is no networks')
             return
 
-        ctxt = context.get_admin_context()
+        self._prepare_instance_filter(instance, network_info)
 
+    def _prepare_instance_filter(self, instance, network_info,
+                                 security_groups=None):
         # create chains for this vif
         tenant_id = instance['project_id']
+        if security_groups is None and len(network_info) > 1:
+            # look the groups up once for all the VIFs
+            security_groups = self.rule_manager.get_security_groups(
+                context.get_admin_context(), instance)
 
         for network in network_info:
             vif_uuid = network[1]['vif_uuid']
@@ -68,9 +101,60 @@ class MidonetFirewallDriver(firewall.FirewallDriver):
                          instance['id'])
                 return
 
-            self.rule_manager.create_for_vif(tenant_id, instance, network,
-                    vif_chains, CONF.allow_same_net_traffic)
-
+            try:
+                self.rule_manager.create_for_vif(tenant_id, instance, network,
+                        vif_chains, CONF.allow_same_net_traffic,
+                        security_groups=security_groups)
+            except Exception:
+                # chains left behind would make the next attempt return
+                # early, leaving the VIF unfiltered
+                try:
+                    self.chain_manager.delete_for_vif(tenant_id, vif_uuid)
+                except Exception:
+                    LOG.warn('Failed to clean up chains of vif=%r', vif_uuid)
+                raise
+
+    @api_stats.tagged
+    def prepare_instance_filters(self, instances):
+        """Prepares the filters of many instances at once, e.g. when a host
+           resumes its instances after a reboot. instances is a list of
+           (instance, network_info) pairs.
+
+           The chains and port groups of each tenant are fetched once for
+           all the instances. Returns a dictionary of the errors keyed by
+           instance uuid.
+        """
+        LOG.debug('instances=%d', len(instances))
+
+        instances = [(i, n) for i, n in instances if n]
+        ctxt = context.get_admin_context()
+        tenant_ids = set(i['project_id'] for i, n in instances)
+
+        with self.rule_manager.snapshot(tenant_ids):
+            return self._prepare_instance_filters(ctxt, instances)
+
+    def _prepare_instance_filters(self, ctxt, instances):
+        tasks = []
+        for instance, network_info in instances:
+            security_groups = self.rule_manager.get_security_groups(ctxt,
+                                                                    instance)
+            tasks.append(functools.partial(self._prepare_instance_filter,
+                                           instance, network_info,
+                                           security_groups))
+
+        results = midonet_lib.run_concurrently(
+            tasks, CONF.MIDONET.bulk_filter_concurrency,
+            return_exceptions=True)
+
+        errors = {}
+        for (instance, network_info), result in zip(instances, results):
+            if isinstance(result, Exception):
+                LOG.error('Failed to prepare filter: instance=%r, error=%r',
+                          instance['id'], result)
+                errors[instance['uuid']] = result
+        return errors
+
+    @api_stats.tagged
     def unfilter_instance(self, instance, network_info):
         LOG.debug('instance=%r, network_info=%r', instance, network_info)
 
@@ -79,23 +163,66 @@ class MidonetFirewallDriver(firewall.FirewallDriver):
                       instance['id'])
             return
 
-        ctxt = context.get_admin_context()
         tenant_id = instance['project_id']
-
-        for network in network_info:
-            vif_uuid = network[1]['vif_uuid']
-            vif_chains = self.chain_manager.delete_for_vif(tenant_id, vif_uuid)
+        vif_uuids = [network[1]['vif_uuid'] for network in network_info]
+        errors = self.chain_manager.delete_for_vifs(tenant_id, vif_uuids)
+        if errors:
+            raise list(errors.values())[0]
+
+    @api_stats.tagged
+    def unfilter_instances(self, instances):
+        """Removes the filters of many instances at once, e.g. when a host is
+           evacuated. instances is a list of (instance, network_info) pairs.
+
+           The chains of each tenant are looked up once. Returns a
+           dictionary keyed by instance uuid of the instances that could
+           not be completely unfiltered, each with a dictionary of the
+           errors keyed by VIF uuid. Unfiltering them again retries the
+           remaining chains.
+        """
+        LOG.debug('instances=%d', len(instances))
+
+        vifs_by_tenant = {}
+        instance_by_vif = {}
+        for instance, network_info in instances:
+            for network in network_info or []:
+                vif_uuid = network[1]['vif_uuid']
+                vifs_by_tenant.setdefault(instance['project_id'],
+                                          []).append(vif_uuid)
+                instance_by_vif[vif_uuid] = instance
+
+        errors = {}
+        for tenant_id, vif_uuids in vifs_by_tenant.items():
+            failed = self.chain_manager.delete_for_vifs(tenant_id, vif_uuids)
+            for vif_uuid, error in failed.items():
+                instance = instance_by_vif[vif_uuid]
+                errors.setdefault(instance['uuid'], {})[vif_uuid] = error
+        return errors
 
     def apply_instance_filter(self, instance, network_info):
         LOG.debug('instance=%r, network_info=%r', instance, network_info)
         pass
 
     def refresh_security_group_rules(self, security_group_id):
+        """Nothing to do: the rules of a security group live in its own
+           chain, which MidonetSecurityGroupHandler keeps up to date.
+        """
         LOG.debug('security_group_id=%r', security_group_id)
 
     def refresh_security_group_members(self, security_group_id):
+        """Nothing to do: rules sourced from a group match its port group,
+           whose members are maintained with the VIFs.
+        """
         LOG.debug('security_group_id=%r', security_group_id)
 
+    def refresh_instance_security_rules(self, instance):
+        """Nothing to do: Nova calls this for every member of a group whose
+           rules change, and those live in the group's chain. Changes of the
+           groups of an instance are applied to its VIFs by
+           MidonetSecurityGroupHandler.
+        """
+        LOG.debug('instance=%r', instance)
+
     def refresh_provider_fw_rules(self):
         LOG.debug('')
 
@@ -111,16 +238,46 @@ class MidonetSecurityGroupHandler(sg.SecurityGroupHandlerBase):
     """
     This is security groups handler for MidoNet.
         When security groups and rules are modified, this handler gets
-        called from nova-api.
+        called from nova-api. With sg_handler_async set, the changes are
+        queued and applied to MidoNet in the background.
     """
 
     def __init__(self, *args, **kwarg):
         LOG.debug('args=%r, kwargs=%r', args, kwarg)
-        self.mido_conn = midonet_connection.get_mido_api()
+        self.mido_conn = midonet_connection.LazyMidonetApi()
         self.chain_manager = midonet_lib.ChainManager(self.mido_conn)
         self.pg_manager = midonet_lib.PortGroupManager(self.mido_conn)
-        self.rule_manager = midonet_lib.RuleManager(self.mido_conn)
-
+        self.rule_manager = midonet_lib.RuleManager(
+            self.mido_conn, chain_manager=self.chain_manager,
+            pg_manager=self.pg_manager)
+        self._rule_index_loaded = False
+        self.queue = None
+        if CONF.MIDONET.sg_handler_async:
+            self.queue = sg_queue.EventQueue(sg_queue.default_path(),
+                                             self.apply_queued_event)
+            self.queue.start()
+
+    @api_stats.tagged
+    def apply_queued_event(self, kind, data):
+        """Applies an event queued in asynchronous mode."""
+        ctxt = context.get_admin_context()
+        tenant_id = data['tenant_id']
+        if kind == sg_queue.SG_CREATE:
+            self._create_security_group(tenant_id, data['sg_id'],
+                                        data['sg_name'], replay=True)
+        elif kind == sg_queue.SG_DESTROY:
+            self._destroy_security_group(tenant_id, data['sg_id'])
+        elif kind == sg_queue.RULE_CREATE:
+            self._create_rules(ctxt, tenant_id, data['rule_ids'])
+        elif kind == sg_queue.RULE_DESTROY:
+            self._destroy_rules(tenant_id, data['rule_ids'])
+        elif kind == sg_queue.INSTANCE_REFRESH:
+            instance = db.instance_get_by_uuid(ctxt, data['instance_uuid'])
+            self._refresh_instance_security_groups(ctxt, instance)
+        else:
+            LOG.error('Unknown queued event kind=%r', kind)
+
+    @api_stats.tagged
     def trigger_security_group_create_refresh(self, context, group):
         """Create a chain and port group for the security group."""
 
@@ -133,52 +290,139 @@ class MidonetSecurityGroupHandler(sg.SecurityGroupHandlerBase):
         sg_id = sg_ref['id']
         sg_name = group['name']
 
+        if self.queue is not None:
+            self.queue.put(sg_queue.SG_CREATE, 'sg:%s' % sg_id,
+                           {'tenant_id': tenant_id, 'sg_id': sg_id,
+                            'sg_name': sg_name})
+            return
+        self._create_security_group(tenant_id, sg_id, sg_name)
+
+    def _create_security_group(self, tenant_id, sg_id, sg_name, replay=False):
+        # nova-compute creates the chain and the port group when an instance
+        # of the group boots before a queued creation is applied, so only a
+        # replayed creation looks them up first
+        cname = midonet_lib.chain_name(sg_id, sg_name)
+        pg_name = midonet_lib.port_group_name(sg_id, sg_name)
+
         # create a chain for the security group
-        self.chain_manager.create_for_sg(tenant_id, sg_id, sg_name)
+        if not (replay and self.chain_manager.get_by_name(tenant_id, cname)):
+            self.chain_manager.create_for_sg(tenant_id, sg_id, sg_name)
 
         # create a port group for the security group
-        self.pg_manager.create(tenant_id, sg_id, sg_name)
+        if not (replay and self.pg_manager.get_by_name(tenant_id, pg_name)):
+            self.pg_manager.create(tenant_id, sg_id, sg_name)
 
+    @api_stats.tagged
     def trigger_security_group_destroy_refresh(self, context,
                                                security_group_id):
         LOG.debug('security_group_id=%r', security_group_id)
 
         tenant_id = context.to_dict()['project_id']
-        # delete corresponding chain
-        self.chain_manager.delete_for_sg(tenant_id, security_group_id)
+        self.rule_manager.invalidate_security_group(security_group_id)
+        if self.queue is not None:
+            self.queue.put(sg_queue.SG_DESTROY, 'sg:%s' % security_group_id,
+                           {'tenant_id': tenant_id,
+                            'sg_id': security_group_id})
+            return
+        self._destroy_security_group(tenant_id, security_group_id)
+
+    def _destroy_security_group(self, tenant_id, sg_id):
+        # delete corresponding chain, its rules being cascade deleted
+        for c in self.chain_manager.delete_for_sg(tenant_id, sg_id):
+            self.rule_manager.rule_index.remove_chain(c.get_id())
 
         # delete the port group
-        self.pg_manager.delete(tenant_id, security_group_id, '')
+        self.pg_manager.delete(tenant_id, sg_id, '')
 
+    @api_stats.tagged
     def trigger_security_group_rule_create_refresh(self, context, rule_ids):
         LOG.debug('rule_ids=%r', rule_ids)
+        if not rule_ids:
+            return
         ctxt = context.elevated()
         tenant_id = context.to_dict()['project_id']
 
+        if self.queue is not None:
+            # the rules passed together belong to one security group
+            sg_id = db.security_group_rule_get(
+                ctxt, rule_ids[0])['parent_group_id']
+            self.queue.put(sg_queue.RULE_CREATE, 'sg:%s' % sg_id,
+                           {'tenant_id': tenant_id,
+                            'rule_ids': list(rule_ids)})
+            return
+        self._create_rules(ctxt, tenant_id, rule_ids)
+
+    def _create_rules(self, ctxt, tenant_id, rule_ids):
+        # group the rules by their security group so that the group and
+        # its MidoNet resources are looked up once per group
+        pending = set(rule_ids)
+        batches = []
         for rule_id in rule_ids:
+            if rule_id not in pending:
+                continue
             rule = db.security_group_rule_get(ctxt, rule_id)
-
-            group = db.security_group_get(ctxt, rule['parent_group_id'])
             sg_id = rule['parent_group_id']
-            sg_name = group['name']
-
-            self.rule_manager.create_for_sg(tenant_id, sg_id, sg_name, rule)
-
+            group = db.security_group_get(ctxt, sg_id)
+
+            rules = [r for r in
+                     db.security_group_rule_get_by_security_group(ctxt, sg_id)
+                     if r['id'] in pending]
+            if rule_id not in [r['id'] for r in rules]:
+                rules.append(rule)
+            for r in rules:
+                pending.discard(r['id'])
+            batches.append((sg_id, group['name'], rules))
+
+        for sg_id, sg_name, rules in batches:
+            self.rule_manager.create_for_sg_rules(tenant_id, sg_id, sg_name,
+                                                  rules)
+
+    @api_stats.tagged
     def trigger_security_group_rule_destroy_refresh(self, context, rule_ids):
         LOG.debug('rule_ids=%r', rule_ids)
-        ctxt = context.elevated()
         tenant_id = context.to_dict()['project_id']
 
-        for rule_id in rule_ids:
-            self.rule_manager.delete_for_sg(tenant_id, rule_id)
+        if self.queue is not None:
+            self.queue.put(sg_queue.RULE_DESTROY, 'rules:%s' % tenant_id,
+                           {'tenant_id': tenant_id,
+                            'rule_ids': list(rule_ids)})
+            return
+        self._destroy_rules(tenant_id, rule_ids)
+
+    def _destroy_rules(self, tenant_id, rule_ids):
+        if CONF.MIDONET.rule_index_preload and not self._rule_index_loaded:
+            # loaded on first use, in the nova-api worker deleting the rules
+            self.rule_manager.rebuild_rule_index()
+            self._rule_index_loaded = True
+        self.rule_manager.delete_for_sg_rules(tenant_id, rule_ids)
 
+    @api_stats.tagged
     def trigger_instance_add_security_group_refresh(self, context, instance,
                                                     group_name):
         LOG.debug('instance=%r, group_name=%r', instance, group_name)
+        self._instance_security_groups_changed(context, instance)
 
+    @api_stats.tagged
     def trigger_instance_remove_security_group_refresh(self, context, instance,
                                                        group_name):
         LOG.debug('instance=%r, group_name=%r', instance, group_name)
+        self._instance_security_groups_changed(context, instance)
+
+    def _instance_security_groups_changed(self, context, instance):
+        if self.queue is not None:
+            self.queue.put(sg_queue.INSTANCE_REFRESH,
+                           'instance:%s' % instance['uuid'],
+                           {'tenant_id': instance['project_id'],
+                            'instance_uuid': instance['uuid']})
+            return
+        self._refresh_instance_security_groups(context.elevated(), instance)
+
+    def _refresh_instance_security_groups(self, ctxt, instance):
+        security_groups = self.rule_manager.get_security_groups(ctxt,
+                                                                instance)
+        for vif_uuid in vif_uuids(instance):
+            self.rule_manager.sync_vif_security_groups(
+                instance['project_id'], vif_uuid, security_groups)
 
     def trigger_security_group_members_refresh(self, context, group_ids):
         LOG.debug('group_ids=%r', group_ids)
@@ -0,0 +1,404 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Durable queue of security group events for MidonetSecurityGroupHandler.
+
+Events are stored in a local SQLite database and applied by worker threads.
+Each event has a key, e.g. the security group it is about; events of a key
+are applied one at a time in the order they were queued, while events of
+different keys may be applied concurrently. Redundant events are coalesced
+when queued, as long as they have not started.
+
+The database may be shared by the processes of a host, e.g. the workers of
+nova-api. Each process opens it and starts its worker threads when it first
+uses the queue, so that a queue created before nova-api forks its workers is
+not shared with them. An event is claimed in a transaction and records the
+pid of the process applying it, so that only the events of dead processes
+are applied again.
+"""
+
+import errno
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import log as logging
+
+
+LOG = logging.getLogger('nova...' + __name__)
+
+sg_queue_opts = [
+    cfg.BoolOpt('sg_handler_async',
+                default=False,
+                help=('Queue the security group events received by nova-api '
+                      'and apply them to MidoNet in the background, so that '
+                      'API requests do not wait for MidoNet.')),
+    cfg.StrOpt('sg_queue_path',
+               default=None,
+               help=('SQLite database holding the queued security group '
+                     'events. Defaults to midonet_sg_queue.sqlite under '
+                     'state_path.')),
+    cfg.IntOpt('sg_queue_workers',
+               default=1,
+               help=('Number of threads applying queued security group '
+                     'events. Events of a security group are always '
+                     'applied in order.')),
+    cfg.IntOpt('sg_queue_max_attempts',
+               default=5,
+               help=('Attempts made to apply a queued event before it is '
+                     'left in the queue as failed.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(sg_queue_opts, 'MIDONET')
+CONF.import_opt('state_path', 'nova.paths')
+
+PENDING = 'pending'
+RUNNING = 'running'
+FAILED = 'failed'
+
+RULE_CREATE = 'rule_create'
+RULE_DESTROY = 'rule_destroy'
+SG_CREATE = 'sg_create'
+SG_DESTROY = 'sg_destroy'
+INSTANCE_REFRESH = 'instance_refresh'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_key ON events (key, seq);
+"""
+
+# seconds between two looks for events left running by dead processes
+RECOVER_INTERVAL = 60
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def default_path():
+    if CONF.MIDONET.sg_queue_path:
+        return CONF.MIDONET.sg_queue_path
+    return os.path.join(CONF.state_path, 'midonet_sg_queue.sqlite')
+
+
+class EventQueue:
+    """Queue of events, each a (kind, key, data) with data a dictionary
+    serializable to JSON, applied by calling apply_func(kind, data).
+    """
+
+    def __init__(self, path, apply_func, workers=None, max_attempts=None):
+        if workers is None:
+            workers = CONF.MIDONET.sg_queue_workers
+        if max_attempts is None:
+            max_attempts = CONF.MIDONET.sg_queue_max_attempts
+        self.path = path
+        self.apply_func = apply_func
+        self.workers = max(workers, 1)
+        self.max_attempts = max_attempts
+        self._open_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._started = False
+        self._stopped = False
+        self._threads = []
+
+        # process that opened the database, None until it is opened
+        self._pid = None
+        self._conn = None
+        self._recovered_at = 0
+
+    def _open(self):
+        """Opens the database and starts the workers in the calling process
+           unless done already. A process forked after the queue was used
+           cannot use the connection and threads of its parent.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._wakeup = threading.Condition(self._lock)
+            self._threads = []
+
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None)
+            conn.executescript(_SCHEMA)
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(events)')]
+            if 'owner' not in columns:
+                conn.execute('ALTER TABLE events ADD COLUMN owner INTEGER')
+            self._conn = conn
+            with self._lock:
+                self._recover()
+            self._pid = os.getpid()
+
+            if self._started:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._work,
+                                         name='midonet-sg-queue-%d' % i)
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+
+    def start(self):
+        """Has worker threads apply the events. They are started in each
+           process when it first queues an event.
+        """
+        self._started = True
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+
+    # queueing
+
+    def _rows(self, where, args):
+        cur = self._conn.execute(
+            'SELECT seq, key, kind, data, state FROM events WHERE %s '
+            'ORDER BY seq' % where, args)
+        return [(seq, key, kind, json.loads(data), state)
+                for seq, key, kind, data, state in cur.fetchall()]
+
+    def _insert(self, key, kind, data):
+        self._conn.execute(
+            'INSERT INTO events (key, kind, data, state) VALUES (?, ?, ?, ?)',
+            (key, kind, json.dumps(data), PENDING))
+
+    def _update_data(self, seq, data):
+        self._conn.execute('UPDATE events SET data = ? WHERE seq = ?',
+                           (json.dumps(data), seq))
+
+    def _delete(self, seq):
+        self._conn.execute('DELETE FROM events WHERE seq = ?', (seq,))
+
+    def put(self, kind, key, data):
+        """Queues an event, coalescing it with the pending events of the
+           key where the outcome stays the same.
+        """
+        LOG.debug('kind=%r, key=%r, data=%r', kind, key, data)
+        self._open()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._put(kind, key, data)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._wakeup.notify()
+
+    def _put(self, kind, key, data):
+        if kind == RULE_DESTROY:
+            rule_ids = self._cancel_rule_creates(data['rule_ids'])
+            if not rule_ids:
+                return
+            data = dict(data, rule_ids=rule_ids)
+            # the parent group of a deleted rule is unknown; delete it after
+            # its creation if that is being applied, else key is used
+            key = self._running_key_for_rules(rule_ids) or key
+
+        rows = self._rows('key = ? AND state != ?', (key, FAILED))
+        pending = [r for r in rows if r[4] == PENDING]
+        last = pending[-1] if pending else None
+
+        if kind == INSTANCE_REFRESH:
+            # the refresh reads the instance's groups when it is applied
+            if last and last[2] == INSTANCE_REFRESH:
+                return
+
+        elif kind == SG_DESTROY:
+            # nothing queued for the group matters once it is gone, and if
+            # its creation had not started either there is nothing to undo
+            for seq, _key, pkind, _data, _state in pending:
+                self._delete(seq)
+            if (any(r[2] == SG_CREATE for r in pending) and
+                    not any(r[4] == RUNNING for r in rows)):
+                return
+            last = None
+
+        if (last and last[2] == kind and
+                kind in (RULE_CREATE, RULE_DESTROY)):
+            seq, _key, _kind, last_data, _state = last
+            last_data['rule_ids'].extend(
+                r for r in data['rule_ids'] if r not in last_data['rule_ids'])
+            self._update_data(seq, last_data)
+            return
+
+        self._insert(key, kind, data)
+
+    def _cancel_rule_creates(self, rule_ids):
+        """Drops the given rules from the pending rule creations. Returns
+           the rules whose creation was not pending, which are still to be
+           deleted.
+        """
+        remaining = list(rule_ids)
+        for seq, key, kind, data, state in self._rows(
+                'kind = ? AND state = ?', (RULE_CREATE, PENDING)):
+            cancelled = [r for r in data['rule_ids'] if r in remaining]
+            if not cancelled:
+                continue
+            data['rule_ids'] = [r for r in data['rule_ids']
+                                if r not in cancelled]
+            if data['rule_ids']:
+                self._update_data(seq, data)
+            else:
+                self._delete(seq)
+            remaining = [r for r in remaining if r not in cancelled]
+        return remaining
+
+    def _running_key_for_rules(self, rule_ids):
+        for seq, key, kind, data, state in self._rows(
+                'kind = ? AND state = ?', (RULE_CREATE, RUNNING)):
+            if any(r in data['rule_ids'] for r in rule_ids):
+                return key
+        return None
+
+    def __len__(self):
+        self._open()
+        with self._lock:
+            cur = self._conn.execute(
+                'SELECT COUNT(*) FROM events WHERE state != ?', (FAILED,))
+            return cur.fetchone()[0]
+
+    # applying
+
+    def _recover(self):
+        """Makes the events being applied by processes that are gone, e.g.
+           stopped while applying them, pending again.
+        """
+        self._recovered_at = time.time()
+        cur = self._conn.execute(
+            'SELECT DISTINCT owner FROM events WHERE state = ?', (RUNNING,))
+        for owner in [r[0] for r in cur.fetchall()]:
+            if owner is not None and _process_alive(owner):
+                continue
+            LOG.info('applying again the events of dead process pid=%r',
+                     owner)
+            self._conn.execute(
+                'UPDATE events SET state = ?, owner = NULL WHERE state = ? '
+                'AND owner IS ?', (PENDING, RUNNING, owner))
+
+    def _claim(self):
+        """Marks the oldest event that can be applied now as running and
+           returns it, or returns None.
+        """
+        if time.time() - self._recovered_at > RECOVER_INTERVAL:
+            self._recover()
+        # other processes may claim from the same database
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            cur = self._conn.execute(
+                'SELECT seq, key, kind, data FROM events e WHERE state = ? '
+                'AND not_before <= ? AND NOT EXISTS (SELECT 1 FROM events o '
+                'WHERE o.key = e.key AND o.seq < e.seq AND o.state != ?) '
+                'ORDER BY seq LIMIT 1', (PENDING, time.time(), FAILED))
+            row = cur.fetchone()
+            claimed = False
+            if row is not None:
+                claimed = self._conn.execute(
+                    'UPDATE events SET state = ?, owner = ? WHERE seq = ? '
+                    'AND state = ?',
+                    (RUNNING, self._pid, row[0], PENDING)).rowcount == 1
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        if not claimed:
+            return None
+        return row[0], row[1], row[2], json.loads(row[3])
+
+    def _done(self, seq, error):
+        with self._lock:
+            if error is None:
+                self._delete(seq)
+            else:
+                cur = self._conn.execute(
+                    'SELECT attempts FROM events WHERE seq = ?', (seq,))
+                attempts = cur.fetchone()[0] + 1
+                if attempts >= self.max_attempts:
+                    state, not_before = FAILED, 0
+                else:
+                    state = PENDING
+                    not_before = time.time() + min(2 ** attempts, 60)
+                self._conn.execute(
+                    'UPDATE events SET state = ?, attempts = ?, '
+                    'not_before = ?, owner = NULL WHERE seq = ?',
+                    (state, attempts, not_before, seq))
+            # the next event of the key may be applied now
+            self._wakeup.notify_all()
+
+    def _work(self):
+        # a green thread copied into a forked process stops; the process
+        # starts its own workers with their own lock
+        pid = os.getpid()
+        wakeup = self._wakeup
+        while True:
+            with wakeup:
+                event = None
+                while not self._stopped and os.getpid() == pid:
+                    event = self._claim()
+                    if event:
+                        break
+                    wakeup.wait(1.0)
+                if self._stopped or os.getpid() != pid:
+                    return
+            self.run_one(event)
+
+    def run_one(self, event):
+        seq, key, kind, data = event
+        LOG.debug('applying seq=%r, key=%r, kind=%r', seq, key, kind)
+        error = None
+        try:
+            self.apply_func(kind, data)
+        except Exception as e:
+            LOG.exception('Failed to apply queued %s event for %s', kind,
+                          key)
+            error = e
+        self._done(seq, error)
+
+    def drain(self):
+        """Applies the events that can be applied now in the calling thread.
+           Returns the number of events applied.
+        """
+        self._open()
+        count = 0
+        while True:
+            with self._lock:
+                event = self._claim()
+            if event is None:
+                return count
+            self.run_one(event)
+            count += 1
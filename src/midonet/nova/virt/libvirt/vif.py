@@ -16,6 +16,9 @@
 
 """MidoNet VIF driver for Libvirt."""
 
+import functools
+import os
+
 from webob import exc as w_exc
 
 from oslo.config import cfg
@@ -25,7 +28,9 @@ from nova.openstack.common import log as logging
 from nova.virt.libvirt import config as vconfig
 from nova.virt.libvirt import vif
 
+from midonet.nova import api_stats
 from midonet.nova import midonet_connection
+from midonet.nova.network import midonet_lib
 
 # Prepend 'nova' so Nova's logger handles.
 LOG = logging.getLogger('nova...' + __name__)
@@ -37,6 +42,17 @@ midonet_vif_driver_opts = [
     cfg.BoolOpt('midonet_use_tunctl',
                 default=False,
                 help='Use tunctl instead of ip command'),
+    cfg.StrOpt('midonet_vif_backend',
+               default='ip',
+               help=('How tap and veth devices are created: "ip" runs the '
+                     'ip or tunctl commands through rootwrap, "netlink" '
+                     'talks netlink from the nova-compute process with '
+                     'pyroute2, which needs CAP_NET_ADMIN, and falls back '
+                     'to "ip" on failure.')),
+    cfg.IntOpt('midonet_bind_concurrency',
+               default=1,
+               help=('Maximum number of concurrent if-vport binding '
+                     'requests made by MidonetVifDriver.bind_vports.')),
     ]
 
 CONF = cfg.CONF
@@ -44,11 +60,29 @@ CONF.register_opts(midonet_vif_driver_opts)
 CONF.import_opt('libvirt_type', 'nova.virt.libvirt.driver')
 
 MAX_MTU_SIZE = '65521' # 65535 minus 14-byte Ethernet header.
+SYS_CLASS_NET = '/sys/class/net'
+
+
+def _get_iproute_class():
+    """Returns pyroute2's IPRoute, imported on first use since only the
+       netlink backend needs it, or None if pyroute2 is not installed.
+    """
+    try:
+        from pyroute2 import IPRoute
+    except ImportError:
+        return None
+    return IPRoute
+
 
 class MidonetVifDriver(vif.LibvirtBaseVIFDriver):
 
     def __init__(self, *args, **kwargs):
-        self.mido_api = midonet_connection.get_mido_api()
+        self.mido_api = midonet_connection.LazyMidonetApi()
+        self._host_uuid = None
+        self._host_uuid_mtime = None
+        self._host = None
+        if CONF.MIDONET.warm_up_caches:
+            midonet_lib.warm_up_in_background('vif', self._get_host)
 
     def get_config(self, instance, vif, image_meta, inst_type):
 
@@ -76,16 +110,30 @@ class MidonetVifDriver(vif.LibvirtBaseVIFDriver):
 
     def _get_host_uuid(self):
         """
-        Get MidoNet host id from host_uuid.properties file.
+        Get MidoNet host id from host_uuid.properties file. The file is parsed
+        again only when its modification time changes.
         """
-        f = open(CONF.midonet_host_uuid_path)
-        lines = f.readlines()
+        path = CONF.midonet_host_uuid_path
+        mtime = os.stat(path).st_mtime
+        if self._host_uuid is not None and mtime == self._host_uuid_mtime:
+            return self._host_uuid
+
+        f = open(path)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
         host_uuid = filter(lambda x: x.startswith('host_uuid='),
                          lines)[0].strip()[len('host_uuid='):]
+        self._host_uuid = host_uuid
+        self._host_uuid_mtime = mtime
         return host_uuid
 
     def _device_exists(self, device):
         """Check if ethernet device exists."""
+        if os.path.isdir(SYS_CLASS_NET):
+            # no need to fork a root-wrapped ip command for this
+            return os.path.exists(os.path.join(SYS_CLASS_NET, device))
         (_out, err) = utils.execute('ip', 'link', 'show', 'dev', device,
                                     check_exit_code=False, run_as_root=True)
         return not err
@@ -99,6 +147,20 @@ class MidonetVifDriver(vif.LibvirtBaseVIFDriver):
         if not create_device:
             return (dev_name, peer_dev_name)
 
+        if CONF.midonet_vif_backend == 'netlink':
+            if _get_iproute_class() is None:
+                LOG.warn('pyroute2 is not installed; creating %s with ip',
+                         dev_name)
+            else:
+                try:
+                    self._create_vif_netlink(vif, dev_name, peer_dev_name)
+                    return (dev_name, peer_dev_name)
+                except Exception:
+                    LOG.exception('Failed to create %s over netlink; '
+                                  'falling back to ip', dev_name)
+                    if self._device_exists(dev_name):
+                        self._delete_tap(dev_name)
+
         if CONF.libvirt_type == 'kvm' or CONF.libvirt_type == 'qemu':
             if CONF.midonet_use_tunctl:
                 utils.execute('tunctl', '-p', '-t', dev_name,
@@ -116,9 +178,28 @@ class MidonetVifDriver(vif.LibvirtBaseVIFDriver):
                       run_as_root=True)
         return (dev_name, peer_dev_name)
 
+    def _create_vif_netlink(self, vif, dev_name, peer_dev_name):
+        """Creates the device, sets the peer's MAC for lxc and brings the
+           device up with MAX_MTU_SIZE over one netlink socket.
+        """
+        ip = _get_iproute_class()()
+        try:
+            if CONF.libvirt_type == 'kvm' or CONF.libvirt_type == 'qemu':
+                ip.link('add', ifname=dev_name, kind='tuntap', mode='tap')
+            elif CONF.libvirt_type == 'lxc':
+                ip.link('add', ifname=dev_name, kind='veth',
+                        peer=peer_dev_name)
+                peer_index = ip.link_lookup(ifname=peer_dev_name)[0]
+                ip.link('set', index=peer_index, address=vif['address'])
+            index = ip.link_lookup(ifname=dev_name)[0]
+            ip.link('set', index=index, state='up', mtu=int(MAX_MTU_SIZE))
+        finally:
+            ip.close()
+
     def _delete_tap(self, dev_name):
         utils.execute('ip', 'link', 'del', dev_name, run_as_root=True)
 
+    @api_stats.tagged
     def plug(self, instance, vif, **kwargs):
         """
         Creates if-vport mapping and returns interface data for the caller.
@@ -134,20 +215,55 @@ class MidonetVifDriver(vif.LibvirtBaseVIFDriver):
             create_device = False
         dev_name, peer_dev_name = self._create_vif(vif, create_device)
 
-        # create if-vport mapping.
+        # create if-vport mapping. As before, an API error is only logged,
+        # but the VM must not boot unbound when MidoNet cannot be reached.
+        error = self.bind_vports([(vport_id, dev_name)]).get(vport_id)
+        if error is not None and not isinstance(error, w_exc.HTTPError):
+            raise error
+
+    def _get_host(self):
+        """Returns the MidoNet host resource of this host, fetched once."""
         host_uuid = self._get_host_uuid()
+        if self._host is not None and self._host.get_id() == host_uuid:
+            return self._host
         try:
-            host = self.mido_api.get_host(host_uuid)
+            self._host = self.mido_api.get_host(host_uuid)
         except w_exc.HTTPError as e:
             LOG.error('Failed to create a if-vport mapping on host=%s',
                       host_uuid)
             raise e
-        try:
+        return self._host
+
+    @api_stats.tagged
+    def bind_vports(self, bindings):
+        """
+        Creates if-vport mappings on this host for a list of (vport_id,
+        dev_name) pairs, e.g. when many VIFs are plugged after a host reboot.
+        Returns a dictionary of the errors keyed by vport id.
+        """
+        host = self._get_host()
+
+        def bind(vport_id, dev_name):
             host.add_host_interface_port().port_id(vport_id)\
                 .interface_name(dev_name).create()
-        except w_exc.HTTPError as e:
-            LOG.warn('Faild binding vport=%r to device=%r', vport_id, dev_name)
 
+        results = midonet_lib.run_concurrently(
+            [functools.partial(bind, vport_id, dev_name)
+             for vport_id, dev_name in bindings],
+            CONF.midonet_bind_concurrency, return_exceptions=True)
+
+        errors = {}
+        for (vport_id, dev_name), result in zip(bindings, results):
+            if isinstance(result, Exception):
+                LOG.warn('Faild binding vport=%r to device=%r: %r', vport_id,
+                         dev_name, result)
+                errors[vport_id] = result
+                if isinstance(result, w_exc.HTTPNotFound):
+                    # the host may have been deleted; look it up again
+                    self._host = None
+        return errors
+
+    @api_stats.tagged
     def unplug(self, instance, vif, **kwargs):
         """
         Tear down the tap interface.
@@ -0,0 +1,229 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (C) 2013 Midokura Japan K.K.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Checks that rule_optimizer.optimize() keeps what the rules of a security
+group accept and accounts for every rule id.
+
+    PYTHONPATH=src python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+import netaddr
+
+from midonet.nova.network import rule_optimizer
+
+
+def rule(rule_id, protocol, from_port, to_port, cidr=None, group_id=None):
+    return {'id': rule_id, 'parent_group_id': 1, 'protocol': protocol,
+            'from_port': from_port, 'to_port': to_port, 'cidr': cidr,
+            'group_id': group_id}
+
+
+def accepts(r, packet):
+    """Tells if a Nova rule accepts a packet given as (protocol number,
+       source address or ('group', id), port or (icmp type, icmp code)).
+    """
+    proto, source, port = packet
+    if r['cidr'] is not None:
+        if isinstance(source, tuple) or \
+                netaddr.IPAddress(source) not in netaddr.IPNetwork(r['cidr']):
+            return False
+    elif source != ('group', r['group_id']):
+        return False
+    if r['protocol'] in (None, ''):
+        return True
+    rule_proto = {'tcp': 6, 'udp': 17, 'icmp': 1}[r['protocol']]
+    if rule_proto != proto:
+        return False
+    if proto == 1:
+        return all(want in (-1, got)
+                   for want, got in zip((r['from_port'], r['to_port']), port))
+    if r['from_port'] is None:
+        return True
+    return r['from_port'] <= port <= r['to_port']
+
+
+def ids(rules):
+    found = []
+    for r in rules:
+        found.extend(rule_optimizer.split_ids(r['id']))
+    return sorted(found)
+
+
+class OptimizeTestCase(unittest.TestCase):
+
+    def assertSameVerdicts(self, rules, packets):
+        optimized = rule_optimizer.optimize(rules)
+        for packet in packets:
+            self.assertEqual(any(accepts(r, packet) for r in rules),
+                             any(accepts(r, packet) for r in optimized),
+                             packet)
+        self.assertEqual(ids(optimized), sorted(str(r['id']) for r in rules))
+        return optimized
+
+    def test_adjacent_cidrs_are_merged(self):
+        rules = [rule(1, 'tcp', 22, 22, '10.0.0.0/25'),
+                 rule(2, 'tcp', 22, 22, '10.0.0.128/25')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, '10.0.0.1', 22), (6, '10.0.0.200', 22),
+                    (6, '10.0.1.1', 22), (6, '10.0.0.1', 23)])
+        self.assertEqual(len(optimized), 1)
+        self.assertEqual(optimized[0]['cidr'], '10.0.0.0/24')
+
+    def test_nested_cidrs_are_folded(self):
+        rules = [rule(1, 'tcp', 80, 80, '10.0.0.0/8'),
+                 rule(2, 'tcp', 80, 80, '10.1.2.0/24')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, '10.1.2.3', 80), (6, '11.0.0.1', 80)])
+        self.assertEqual(len(optimized), 1)
+        self.assertEqual(optimized[0]['cidr'], '10.0.0.0/8')
+
+    def test_different_ports_are_not_merged(self):
+        rules = [rule(1, 'tcp', 22, 22, '10.0.0.0/25'),
+                 rule(2, 'tcp', 80, 80, '10.0.0.128/25')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, '10.0.0.1', 80), (6, '10.0.0.200', 22),
+                    (6, '10.0.0.1', 22), (6, '10.0.0.200', 80)])
+        self.assertEqual(len(optimized), 2)
+
+    def test_adjacent_port_ranges_are_collapsed(self):
+        rules = [rule(1, 'udp', 1000, 1999, '0.0.0.0/0'),
+                 rule(2, 'udp', 2000, 2999, '0.0.0.0/0'),
+                 rule(3, 'udp', 3001, 4000, '0.0.0.0/0')]
+        optimized = self.assertSameVerdicts(
+            rules, [(17, '1.2.3.4', p) for p in (999, 1999, 2000, 3000, 3001)])
+        self.assertEqual(sorted((r['from_port'], r['to_port'])
+                                for r in optimized),
+                         [(1000, 2999), (3001, 4000)])
+
+    def test_icmp_wildcard_covers_specific_types(self):
+        rules = [rule(1, 'icmp', -1, -1, '0.0.0.0/0'),
+                 rule(2, 'icmp', 8, 0, '10.0.0.0/8'),
+                 rule(3, 'icmp', 3, -1, '0.0.0.0/0')]
+        optimized = self.assertSameVerdicts(
+            rules, [(1, '10.0.0.1', (8, 0)), (1, '8.8.8.8', (3, 4))])
+        self.assertEqual(len(optimized), 1)
+        self.assertEqual(sorted(rule_optimizer.split_ids(optimized[0]['id'])),
+                         ['1', '2', '3'])
+
+    def test_icmp_type_does_not_cover_other_types(self):
+        rules = [rule(1, 'icmp', 8, -1, '0.0.0.0/0'),
+                 rule(2, 'icmp', 0, 0, '0.0.0.0/0')]
+        optimized = self.assertSameVerdicts(
+            rules, [(1, '1.1.1.1', (8, 0)), (1, '1.1.1.1', (0, 0)),
+                    (1, '1.1.1.1', (3, 0))])
+        self.assertEqual(len(optimized), 2)
+
+    def test_any_protocol_covers_every_protocol(self):
+        rules = [rule(1, None, None, None, '10.0.0.0/8'),
+                 rule(2, 'tcp', 22, 22, '10.0.0.0/16'),
+                 rule(3, 'icmp', -1, -1, '10.1.0.0/16'),
+                 rule(4, 'tcp', 22, 22, '192.168.0.0/16')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, '10.0.0.1', 22), (1, '10.1.0.1', (8, 0)),
+                    (17, '10.2.0.1', 53), (6, '192.168.0.1', 22),
+                    (6, '192.168.0.1', 80)])
+        self.assertEqual(len(optimized), 2)
+
+    def test_specific_protocol_does_not_cover_any_protocol(self):
+        rules = [rule(1, 'tcp', 1, 65535, '0.0.0.0/0'),
+                 rule(2, None, None, None, '10.0.0.0/8')]
+        optimized = self.assertSameVerdicts(
+            rules, [(17, '10.0.0.1', 53), (6, '1.1.1.1', 22)])
+        self.assertEqual(len(optimized), 2)
+
+    def test_group_sources(self):
+        rules = [rule(1, 'tcp', 22, 22, group_id=7),
+                 rule(2, 'tcp', 23, 30, group_id=7),
+                 rule(3, 'tcp', 22, 22, group_id=8),
+                 rule(4, 'tcp', 1, 65535, '0.0.0.0/0')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, ('group', 7), 25), (6, ('group', 8), 25),
+                    (6, ('group', 8), 22), (6, '1.1.1.1', 25)])
+        # a CIDR never covers a group, nor a group another one
+        self.assertEqual(len(optimized), 3)
+        by_group = dict((r['group_id'], r) for r in optimized)
+        self.assertEqual((by_group[7]['from_port'], by_group[7]['to_port']),
+                         (22, 30))
+        self.assertIsNone(by_group[7]['cidr'])
+
+    def test_ipv6_is_kept_apart(self):
+        rules = [rule(1, 'tcp', 22, 22, '::/0'),
+                 rule(2, 'tcp', 22, 22, '10.0.0.0/8'),
+                 rule(3, 'tcp', 22, 22, '2001:db8::/32')]
+        optimized = self.assertSameVerdicts(
+            rules, [(6, '10.0.0.1', 22), (6, '2001:db8::1', 22),
+                    (6, '11.0.0.1', 22)])
+        self.assertEqual(len(optimized), 2)
+
+    def test_random_rules_keep_their_verdicts(self):
+        rnd = random.Random(42)
+        protocols = [None, 'tcp', 'udp', 'icmp']
+        for i in range(50):
+            rules = []
+            for rule_id in range(rnd.randint(1, 12)):
+                proto = rnd.choice(protocols)
+                if rnd.random() < 0.2:
+                    source = {'group_id': rnd.randint(1, 2)}
+                else:
+                    length = rnd.choice([8, 16, 23, 24, 25, 32])
+                    net = netaddr.IPNetwork('10.%d.%d.%d/%d' % (
+                        rnd.randint(0, 1), rnd.randint(0, 1),
+                        rnd.choice([0, 128]), length)).cidr
+                    source = {'cidr': str(net)}
+                if proto in ('tcp', 'udp'):
+                    start = rnd.randint(1, 30)
+                    ports = (start, start + rnd.randint(0, 10))
+                elif proto == 'icmp':
+                    ports = (rnd.choice([-1, 0, 8]), rnd.choice([-1, 0]))
+                else:
+                    ports = (None, None)
+                rules.append(rule(rule_id, proto, ports[0], ports[1],
+                                  **source))
+            packets = []
+            for j in range(200):
+                proto = rnd.choice([1, 6, 17])
+                if rnd.random() < 0.2:
+                    source = ('group', rnd.randint(1, 2))
+                else:
+                    source = '10.%d.%d.%d' % (rnd.randint(0, 1),
+                                              rnd.randint(0, 1),
+                                              rnd.randint(0, 255))
+                if proto == 1:
+                    port = (rnd.choice([0, 3, 8]), rnd.choice([0, 1]))
+                else:
+                    port = rnd.randint(0, 45)
+                packets.append((proto, source, port))
+            self.assertSameVerdicts(rules, packets)
+
+
+class IdsTestCase(unittest.TestCase):
+
+    def test_split_joined_ids(self):
+        self.assertEqual(rule_optimizer.split_ids(
+            rule_optimizer.join_ids([1, '2', 3])), ['1', '2', '3'])
+
+    def test_split_single_and_missing_ids(self):
+        self.assertEqual(rule_optimizer.split_ids(5), ['5'])
+        self.assertEqual(rule_optimizer.split_ids(None), [])
+        self.assertEqual(rule_optimizer.split_ids(''), [])
+
+
+if __name__ == '__main__':
+    unittest.main()